@@ -0,0 +1,63 @@
+"""Check the HTML extraction backends against saved pages and time them.
+
+Usage: python benchmarks/bench_extractors.py [iterations]
+
+Every backend must return exactly what the full BeautifulSoup tree
+("soup") returns for each fixture page, otherwise the script exits
+with an error before timing anything.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import wallpaper
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Fixture page -> extractor that scrapes it
+PAGES = {
+    "alphacoders_listing.html": wallpaper.extract_alphacoders_listing,
+    "wallhaven_listing.html": wallpaper.extract_wallhaven_listing,
+    "wallhaven_detail.html": wallpaper.extract_wallhaven_detail,
+}
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+def validate(pages):
+    """Compare every backend with the reference backend; return the list of mismatches."""
+    errors = []
+    for name, extractor in PAGES.items():
+        expected = extractor(pages[name], "soup")
+        if not expected:
+            errors.append(f"{name}: reference backend found nothing")
+        for backend in wallpaper.PARSER_BACKENDS:
+            result = extractor(pages[name], backend)
+            if result != expected:
+                errors.append(f"{name}: {backend} returned {result!r}, expected {expected!r}")
+    return errors
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    pages = {name: load_fixture(name) for name in PAGES}
+
+    errors = validate(pages)
+    if errors:
+        for error in errors:
+            print(f"MISMATCH {error}")
+        sys.exit(1)
+    print("All backends agree on every fixture page.\n")
+
+    print(f"{'page':<28}" + "".join(f"{backend:>12}" for backend in wallpaper.PARSER_BACKENDS))
+    for name, extractor in PAGES.items():
+        row = f"{name:<28}"
+        for backend in wallpaper.PARSER_BACKENDS:
+            seconds = timeit.timeit(lambda: extractor(pages[name], backend), number=iterations)
+            row += f"{seconds / iterations * 1000:>10.3f}ms"
+        print(row)
+
+if __name__ == "__main__":
+    main()
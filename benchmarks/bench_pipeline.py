@@ -0,0 +1,198 @@
+"""End-to-end benchmark of the wallpaper change pipeline, fully offline.
+
+Starts the stand-in server in a child process, points every category of
+wallpaper_sources at it and runs a number of changes. Reports p50/p99
+time-to-set, bytes transferred, requests per change and peak RSS, and
+writes the report to a JSON file so runs can be compared across versions.
+
+Usage: python benchmarks/bench_pipeline.py [--changes 20] [--latency-ms 50]
+           [--error-rate 0.05] [--throttle-rate 0.02] [--prefetch] [--wallhaven-html]
+           [--api-key KEY]
+           [--output benchmarks/results/pipeline.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import standin_server
+
+def serve(port_queue, settings):
+    """Child process: run the stand-in server and report its port."""
+    server = standin_server.start_server(0, **settings)
+    port_queue.put(server.server_address[1])
+    while True:
+        time.sleep(3600)
+
+def server_stats(base_url):
+    with urllib.request.urlopen(base_url + "/__stats") as response:
+        return json.load(response)
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where unsupported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def code_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+def download_attempts(snapshot):
+    """Number of download_new_wallpaper runs in a metrics snapshot."""
+    return sum(totals["count"] for totals in snapshot["stages"]
+               if totals["stage"] == "download_new_wallpaper")
+
+def point_sources_at(changer, base_url, wallhaven_html=False):
+    """Replace every category's sources with the stand-in equivalents."""
+    wallhaven = "wallhaven/search" if wallhaven_html else "wallhaven/api/v1/search"
+    for category in changer.wallpaper_sources:
+        changer.wallpaper_sources[category] = [
+            f"{base_url}/alphacoders/by_category.php?name={category}",
+            f"{base_url}/{wallhaven}?q={category}&sorting=random",
+        ]
+
+def run(args):
+    settings = {
+        "latency_ms": args.latency_ms, "error_rate": args.error_rate,
+        "throttle_rate": args.throttle_rate, "thumb_ratio": args.thumb_ratio, "seed": args.seed,
+        "broken": args.broken, "api_key": args.api_key
+    }
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port_queue, settings), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+    work_dir = tempfile.mkdtemp(prefix="wallpaper-bench-")
+    old_cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        # The config file is read from the working directory
+        with open("wallpaper_config.json", "w") as f:
+            json.dump({
+                "prefetch_count": args.prefetch_count if args.prefetch else 0,
+                "display_size": args.display_size,
+                "library_max_mb": 200,
+                "wallpaper_setter": "none",  # Leave the desktop alone
+                "wallhaven_api_key": args.api_key or ""
+            }, f)
+
+        import wallpaper
+        changer = wallpaper.WallpaperChanger()
+        point_sources_at(changer, base_url, args.wallhaven_html)
+        if args.prefetch:
+            changer.prefetcher.start()
+
+        times = []
+        failures = 0
+        start_stats = server_stats(base_url)
+        for number in range(args.changes):
+            if args.prefetch:
+                # Give the prefetcher the time a real interval would
+                time.sleep(args.interval)
+            before = changer.current_wallpaper
+            started = time.perf_counter()
+            changer.change_wallpaper()
+            elapsed = time.perf_counter() - started
+            if changer.current_wallpaper == before:
+                failures += 1
+            times.append(elapsed)
+            print(f"change {number + 1}/{args.changes}: {elapsed * 1000:.1f} ms", file=sys.stderr)
+        end_stats = server_stats(base_url)
+        attempts = changer.metrics.snapshot()
+        changer.prefetcher.stop()
+        # Let the losing downloads of the last change notice they were cancelled
+        changer.fetcher.shutdown(wait=True)
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        server.terminate()
+
+    requests_made = end_stats["requests"] - start_stats["requests"]
+    bytes_sent = end_stats["bytes"] - start_stats["bytes"]
+    return {
+        "version": code_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "settings": dict(settings, changes=args.changes, prefetch=args.prefetch,
+                         interval=args.interval, display_size=args.display_size,
+                         wallhaven_html=args.wallhaven_html),
+        "time_to_set_ms": {
+            "p50": percentile(times, 0.50) * 1000,
+            "p99": percentile(times, 0.99) * 1000,
+            "mean": sum(times) / len(times) * 1000,
+            "max": max(times) * 1000,
+        },
+        "failed_changes": failures,
+        "attempts_per_change": download_attempts(attempts) / args.changes,
+        "requests": requests_made,
+        "requests_per_change": requests_made / args.changes,
+        "bytes_transferred": bytes_sent,
+        "bytes_per_change": bytes_sent / args.changes,
+        "server_errors": end_stats["errors"] - start_stats["errors"],
+        "server_throttled": end_stats["throttled"] - start_stats["throttled"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--changes", type=int, default=20)
+    parser.add_argument("--prefetch", action="store_true", help="measure with the prefetch buffer running")
+    parser.add_argument("--prefetch-count", type=int, default=2)
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between changes with --prefetch")
+    parser.add_argument("--display-size", default="1920x1080")
+    parser.add_argument("--wallhaven-html", action="store_true",
+                        help="scrape wallhaven search and detail pages instead of using its API")
+    parser.add_argument("--output", help="report file (default: benchmarks/results/pipeline-<time>.json)")
+    standin_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"pipeline-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+
+    timing = report["time_to_set_ms"]
+    print(f"time to set: p50 {timing['p50']:.1f} ms, p99 {timing['p99']:.1f} ms")
+    print(f"requests per change: {report['requests_per_change']:.1f}")
+    print(f"download attempts per change: {report['attempts_per_change']:.2f}")
+    print(f"bytes per change: {report['bytes_per_change'] / 1024:.0f} KB")
+    if report["peak_rss_mb"] is not None:
+        print(f"peak RSS: {report['peak_rss_mb']:.1f} MB")
+    print(f"failed changes: {report['failed_changes']}")
+    print(f"report written to {output}")
+
+if __name__ == "__main__":
+    main()
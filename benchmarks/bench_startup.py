@@ -0,0 +1,124 @@
+"""Compare startup cost of the headless commands with the GUI path.
+
+Every scenario runs in a fresh interpreter, several times. Reports the
+median time spent importing and initialising, the median wall time of
+the whole process and its peak RSS.
+
+Usage: python benchmarks/bench_startup.py [--repeat 5] [--baseline REV]
+
+--baseline times `import wallpaper` at an older git revision too, e.g.
+one from before imports were made lazy.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# What the tray application imports before it can show its icon
+GUI_MODULES = ["tkinter", "tkinter.ttk", "tkinter.messagebox", "pystray", "PIL.Image",
+               "bs4", "requests", "numpy"]
+
+SCENARIOS = {
+    "import wallpaper": "import wallpaper",
+    "status command": "import wallpaper; wallpaper.main(['status'])",
+    "headless changer": "import wallpaper; wallpaper.WallpaperChanger()",
+    "GUI imports": "import importlib, wallpaper\n"
+                   f"for name in {GUI_MODULES!r}: importlib.import_module(name)",
+}
+
+CHILD = """
+import sys, time, json
+sys.path.insert(0, {path!r})
+started = time.perf_counter()
+import contextlib, io
+with contextlib.redirect_stdout(io.StringIO()):
+{code}
+seconds = time.perf_counter() - started
+try:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+except ImportError:
+    rss_mb = None
+print(json.dumps({{"seconds": seconds, "rss_mb": rss_mb}}))
+"""
+
+def run_child(code, path, work_dir):
+    """Run one scenario in a new interpreter; return (seconds, wall seconds, rss MB)."""
+    script = CHILD.format(path=path, code="\n".join("    " + line for line in code.splitlines()))
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", script], cwd=work_dir,
+                            capture_output=True, text=True, timeout=120)
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return report["seconds"], wall, report["rss_mb"]
+
+def measure(code, path, work_dir, repeat):
+    runs = [run_child(code, path, work_dir) for _ in range(repeat)]
+    rss = [run[2] for run in runs if run[2] is not None]
+    return {
+        "seconds": statistics.median(run[0] for run in runs),
+        "wall_seconds": statistics.median(run[1] for run in runs),
+        "rss_mb": statistics.median(rss) if rss else None,
+    }
+
+def baseline_source(revision):
+    """Write wallpaper.py as of revision to a temp dir and return the dir."""
+    source = subprocess.run(["git", "show", f"{revision}:wallpaper.py"], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True).stdout
+    directory = tempfile.mkdtemp(prefix="wallpaper-baseline-")
+    with open(os.path.join(directory, "wallpaper.py"), "w", newline="") as f:
+        f.write(source)
+    return directory
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", help="git revision to time `import wallpaper` at")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="wallpaper-startup-")
+    with open(os.path.join(work_dir, "wallpaper_config.json"), "w") as f:
+        json.dump({"wallpaper_setter": "none", "renditions": False}, f)
+
+    scenarios = [(name, code, REPO_DIR) for name, code in SCENARIOS.items()]
+    baseline_dir = None
+    if args.baseline:
+        baseline_dir = baseline_source(args.baseline)
+        scenarios.append((f"import wallpaper @ {args.baseline}", "import wallpaper", baseline_dir))
+
+    results = {}
+    print(f"{'scenario':<32}{'startup':>12}{'process':>12}{'peak RSS':>12}")
+    try:
+        for name, code, path in scenarios:
+            try:
+                result = measure(code, path, work_dir, args.repeat)
+            except Exception as e:
+                print(f"{name:<32}  failed: {e}")
+                results[name] = {"error": str(e)}
+                continue
+            results[name] = result
+            rss = f"{result['rss_mb']:.1f} MB" if result["rss_mb"] is not None else "n/a"
+            print(f"{name:<32}{result['seconds'] * 1000:>9.1f} ms{result['wall_seconds'] * 1000:>9.1f} ms{rss:>12}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if baseline_dir:
+            shutil.rmtree(baseline_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
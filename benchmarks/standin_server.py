@@ -0,0 +1,294 @@
+"""Local stand-in for alphacoders and wallhaven used by the benchmarks.
+
+Serves the recorded pages in benchmarks/fixtures with their links
+rewritten to point back at this server, plus generated JPEGs of several
+sizes. Latency, server errors and throttling can be simulated.
+
+Usage: python benchmarks/standin_server.py [--port 8000] [--latency-ms 50] ...
+
+/wallhaven/api/v1/search answers like wallhaven's JSON search API.
+
+GET /__stats returns request and byte counters as JSON.
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from PIL import Image
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Resolutions served for full images; thumbnails are 350x219 like alphacoders
+IMAGE_SIZES = [(1920, 1080), (2560, 1440), (3840, 2160)]
+THUMB_SIZE = (350, 219)
+
+# Shape of the wallhaven API search results
+API_PER_PAGE = 24
+API_LAST_PAGE = 5
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+def generate_image(seed, size):
+    """Return JPEG bytes of a distinct, deterministic picture for seed."""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    # Coarse random blocks scaled up: distinct perceptual hashes, cheap to encode
+    blocks = rng.integers(0, 256, (max(height // 120, 2), max(width // 120, 2), 3), dtype=np.uint8)
+    img = Image.fromarray(blocks).resize(size, Image.BILINEAR)
+    output = io.BytesIO()
+    img.save(output, "JPEG", quality=90, progressive=bool(seed % 2))
+    return output.getvalue()
+
+class StandinState:
+    """Settings and counters shared by all request handlers."""
+    def __init__(self, latency_ms=0, error_rate=0.0, throttle_rate=0.0, thumb_ratio=0.3, seed=1, broken=(),
+                 api_key=None):
+        self.latency = latency_ms / 1000
+        self.broken = tuple(broken)  # Sources whose every page fails
+        self.api_key = api_key  # Required by the API when set
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.thumb_ratio = thumb_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.images = {}
+        self.seed_counter = seed * 1000000
+        self.pools = {size: queue.Queue() for size in IMAGE_SIZES + [THUMB_SIZE]}
+        self.stats = {"requests": 0, "bytes": 0, "errors": 0, "throttled": 0, "by_kind": {}}
+        self.pages = {
+            "alphacoders": load_fixture("alphacoders_listing.html"),
+            "wallhaven": load_fixture("wallhaven_listing.html"),
+            "detail": load_fixture("wallhaven_detail.html"),
+        }
+
+    def count(self, kind, nbytes):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += nbytes
+            self.stats["by_kind"][kind] = self.stats["by_kind"].get(kind, 0) + 1
+
+    def roll(self):
+        """Return (failure, salt): failure is None, 'error' or 'throttle', salt varies listings."""
+        with self.lock:
+            value = self.random.random()
+            salt = self.random.getrandbits(32)
+        if value < self.error_rate:
+            return "error", salt
+        if value < self.error_rate + self.throttle_rate:
+            return "throttle", salt
+        return None, salt
+
+    def image(self, name):
+        """Return the JPEG bytes for an image name, assigning it a fresh image on first use."""
+        with self.lock:
+            if name in self.images:
+                return self.images[name]
+        data = self.pools[self.image_size(name)].get()
+        with self.lock:
+            # Another request for the same name may have won the race
+            data = self.images.setdefault(name, data)
+        return data
+
+    def image_size(self, name):
+        """Return the (width, height) an image name is served at."""
+        seed = zlib.crc32(name.encode())
+        if (seed % 1000) / 1000 < self.thumb_ratio:
+            return THUMB_SIZE
+        return IMAGE_SIZES[seed % len(IMAGE_SIZES)]
+
+    def fill_pools(self, count):
+        """Pre-generate images so responses aren't delayed by JPEG encoding."""
+        for size in self.pools:
+            while self.pools[size].qsize() < count:
+                self.pools[size].put(generate_image(self.next_seed(), size))
+
+    def next_seed(self):
+        with self.lock:
+            self.seed_counter += 1
+            return self.seed_counter
+
+    def keep_pools_filled(self, count):
+        """Background thread: top the pools up as images are handed out."""
+        while True:
+            self.fill_pools(count)
+            time.sleep(0.05)
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # A client closed its keep-alive connection; nothing left to answer
+            pass
+
+    def base_url(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def do_GET(self):
+        path = self.path
+        if path == "/__stats":
+            with self.state.lock:
+                body = json.dumps(self.state.stats).encode()
+            return self.send_body(body, "application/json", count=False)
+
+        time.sleep(self.state.latency)
+        failure, salt = self.state.roll()
+        if any(path.startswith(f"/{name}/") for name in self.state.broken):
+            failure = "error"
+        if failure == "error":
+            with self.state.lock:
+                self.state.stats["errors"] += 1
+            return self.send_body(b"Service Unavailable", "text/plain", status=503, kind="error")
+        if failure == "throttle":
+            with self.state.lock:
+                self.state.stats["throttled"] += 1
+            return self.send_body(b"Too Many Requests", "text/plain", status=429,
+                                  headers={"Retry-After": "1"}, kind="throttle")
+
+        base = self.base_url()
+        if path.startswith("/alphacoders/"):
+            # Every fetch lists different images, like a busy category page
+            html = re.sub(
+                r"//images\d\.alphacoders\.com/\d+/thumb-350-(\d+)\.jpg",
+                lambda m: f"{base}/img/a{salt:x}-{m.group(1)}.jpg",
+                self.state.pages["alphacoders"]
+            )
+            return self.send_body(html.encode(), "text/html", kind="listing")
+        if path.startswith("/wallhaven/api/v1/search"):
+            return self.send_api_search(base, salt)
+        if path.startswith("/wallhaven/search"):
+            html = self.state.pages["wallhaven"].replace(
+                "https://wallhaven.cc/w/", f"{base}/wallhaven/w/{salt:x}-"
+            )
+            return self.send_body(html.encode(), "text/html", kind="listing")
+        if path.startswith("/wallhaven/w/"):
+            wallpaper_id = path.rsplit("/", 1)[-1]
+            html = self.state.pages["detail"].replace(
+                "https://w.wallhaven.cc/full/8o/wallhaven-8oxr1j.jpg", f"{base}/full/{wallpaper_id}.jpg"
+            )
+            return self.send_body(html.encode(), "text/html", kind="detail")
+        if path.startswith("/img/") or path.startswith("/full/"):
+            name = path.rsplit("/", 1)[-1]
+            if path.startswith("/full/"):
+                name = "full-" + name
+            return self.send_image(self.state.image(name))
+        self.send_body(b"Not Found", "text/plain", status=404, kind="missing")
+
+    def send_api_search(self, base, salt):
+        """Answer like wallhaven's JSON search API: 24 wallpapers per page, 5 pages per seed."""
+        if self.state.api_key and self.headers.get("X-API-Key") != self.state.api_key:
+            return self.send_body(b'{"error": "Unauthorized"}', "application/json", status=401, kind="api_denied")
+        query = parse_qs(urlparse(self.path).query)
+        page = int(query.get("page", ["1"])[0])
+        seed = query.get("seed", [f"{salt:x}"])[0]
+        data = []
+        if page <= API_LAST_PAGE:
+            for number in range(API_PER_PAGE):
+                wallpaper_id = f"{seed}-{page}-{number}"
+                width, height = self.state.image_size(f"full-{wallpaper_id}.jpg")
+                data.append({
+                    "id": wallpaper_id,
+                    "url": f"{base}/wallhaven/w/{wallpaper_id}",
+                    "path": f"{base}/full/{wallpaper_id}.jpg",
+                    "resolution": f"{width}x{height}",
+                    "dimension_x": width,
+                    "dimension_y": height,
+                    # Estimated: the JPEG is only picked when first requested
+                    "file_size": width * height // 8,
+                    "file_type": "image/jpeg",
+                })
+        body = json.dumps({
+            "data": data,
+            "meta": {"current_page": page, "last_page": API_LAST_PAGE, "per_page": API_PER_PAGE,
+                     "total": API_LAST_PAGE * API_PER_PAGE, "query": query.get("q", [""])[0], "seed": seed}
+        })
+        self.send_body(body.encode(), "application/json", kind="api")
+
+    def send_image(self, data):
+        """Send an image, honouring a single bytes=start-end Range header."""
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            end = min(end, len(data) - 1)
+            return self.send_body(data[start:end + 1], "image/jpeg", status=206, kind="image_range",
+                                  headers={"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+        self.send_body(data, "image/jpeg", kind="image")
+
+    def send_body(self, body, content_type, status=200, headers=None, kind=None, count=True):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        sent = 0
+        try:
+            # Write in pieces so clients that stop reading early are counted fairly
+            for start in range(0, len(body), 65536):
+                self.wfile.write(body[start:start + 65536])
+                sent += min(65536, len(body) - start)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        if count:
+            self.state.count(kind, sent)
+
+def start_server(port=0, pool_size=8, **settings):
+    """Start the stand-in server on a background thread and return it."""
+    state = StandinState(**settings)
+    state.fill_pools(pool_size)
+    threading.Thread(target=state.keep_pools_filled, args=(pool_size,), daemon=True).start()
+    handler = type("Handler", (StandinHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_arguments(parser):
+    """Add the stand-in server options to an argparse parser."""
+    parser.add_argument("--latency-ms", type=float, default=50, help="delay before every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction answered with 429")
+    parser.add_argument("--thumb-ratio", type=float, default=0.3, help="fraction of images that are thumbnails")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--broken", action="append", default=[], choices=["alphacoders", "wallhaven"],
+                        help="make every listing of this source fail with 503 (repeatable)")
+    parser.add_argument("--api-key", help="require this X-API-Key on wallhaven API requests")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(
+        args.port, latency_ms=args.latency_ms, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, thumb_ratio=args.thumb_ratio, seed=args.seed, broken=args.broken,
+        api_key=args.api_key
+    )
+    print(f"Stand-in server listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Shared test setup: import wallpaper and the benchmark helpers from the checkout."""
+import json
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "benchmarks"))
+sys.path.insert(0, REPO_DIR)
+
+import standin_server
+import wallpaper
+
+@pytest.fixture
+def changer_settings():
+    """Config values a test module wants on top of the changer defaults below."""
+    return {}
+
+@pytest.fixture
+def changer(tmp_path, monkeypatch, changer_settings):
+    """A WallpaperChanger working in tmp_path that never touches the desktop."""
+    monkeypatch.chdir(tmp_path)
+    with open("wallpaper_config.json", "w") as f:
+        json.dump(dict({
+            "wallpaper_setter": "none",
+            "prefetch_count": 0,
+            "display_size": "1920x1080",
+            "max_retries": 0
+        }, **changer_settings), f)
+    changer = wallpaper.WallpaperChanger()
+    yield changer
+    changer.fetcher.shutdown(wait=True)
+
+@pytest.fixture
+def standin():
+    """Start benchmark stand-in servers with the given settings; returns their base URL."""
+    servers = []
+
+    def start(**settings):
+        server = standin_server.start_server(0, pool_size=2, **dict({"latency_ms": 0}, **settings))
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+    yield start
+    for server in servers:
+        server.shutdown()
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+import standin_server
+import wallpaper
+
+def test_cancel_reaches_children_but_not_parents():
+    parent = wallpaper.ChangeContext()
+    child = parent.child()
+    grandchild = child.child()
+    sibling = parent.child()
+    child.cancel()
+    assert child.cancelled and grandchild.cancelled
+    assert not parent.is_set() and not sibling.is_set()
+    parent.cancel()
+    assert sibling.cancelled
+    # Children made after the cancel start out cancelled
+    assert parent.child().cancelled
+
+def test_expiry_is_set_but_not_cancelled():
+    context = wallpaper.ChangeContext(timeout=0.05)
+    assert not context.is_set()
+    assert 0 < context.remaining() <= 0.05
+    time.sleep(0.06)
+    assert context.is_set() and context.expired()
+    assert not context.cancelled
+    assert context.remaining() == 0.0
+
+def test_children_share_the_deadline():
+    parent = wallpaper.ChangeContext(timeout=30)
+    assert parent.child().deadline == parent.deadline
+    assert wallpaper.ChangeContext().remaining() is None
+
+def test_wait_wakes_on_cancel():
+    context = wallpaper.ChangeContext()
+    threading.Timer(0.05, context.cancel).start()
+    started = time.monotonic()
+    assert context.wait(5)
+    assert time.monotonic() - started < 1
+
+def test_wait_ends_at_the_deadline():
+    context = wallpaper.ChangeContext(timeout=0.05)
+    started = time.monotonic()
+    assert context.wait(5)
+    assert time.monotonic() - started < 1
+
+def test_get_out_of_time_raises_change_cancelled(monkeypatch):
+    client = wallpaper.HttpClient()
+    context = wallpaper.ChangeContext(timeout=30)
+    # The deadline passes between the is_set() check and the timeout cap
+    monkeypatch.setattr(context, "remaining", lambda: 0.0)
+    monkeypatch.setattr(client.session, "get", lambda *args, **kwargs: pytest.fail("request sent"))
+    with pytest.raises(wallpaper.ChangeCancelled):
+        client.get("http://127.0.0.1:9/", context)
+
+def test_cancel_interrupts_retry_backoff():
+    # Every request is answered with 429 and Retry-After: 1
+    server = standin_server.start_server(0, pool_size=1, latency_ms=0, throttle_rate=1.0)
+    try:
+        client = wallpaper.HttpClient(retries=3)
+        context = wallpaper.ChangeContext()
+        threading.Timer(0.2, context.cancel).start()
+        started = time.monotonic()
+        with pytest.raises(wallpaper.ChangeCancelled):
+            client.get(f"http://127.0.0.1:{server.server_address[1]}/alphacoders/", context)
+        assert time.monotonic() - started < 0.9
+    finally:
+        server.shutdown()
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import wallpaper
+
+def test_returns_the_first_truthy_result_and_stops_starting_jobs():
+    fetcher = wallpaper.ConcurrentFetcher(max_workers=4, per_host=2)
+    started = []
+
+    def job(item, cancel_event):
+        started.append(item)
+        return item if item == 3 else None
+
+    assert fetcher.first_result(job, range(100)) == 3
+    fetcher.shutdown(wait=True)
+    # A window of two: at most one item past the winner was started
+    assert max(started) <= 4
+
+def test_keeps_at_most_window_jobs_queued():
+    fetcher = wallpaper.ConcurrentFetcher(max_workers=8, per_host=2)
+    lock = threading.Lock()
+    running = [0, 0]  # now, most at once
+
+    def job(item, cancel_event):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return None
+
+    assert fetcher.first_result(job, range(20), window=3) is None
+    fetcher.shutdown(wait=True)
+    assert running[1] == 3
+
+def test_failing_jobs_are_skipped():
+    fetcher = wallpaper.ConcurrentFetcher(max_workers=2, per_host=2)
+
+    def job(item, cancel_event):
+        if item < 3:
+            raise ValueError("broken candidate")
+        return item
+
+    assert fetcher.first_result(job, range(5)) in (3, 4)
+    fetcher.shutdown(wait=True)
+
+def test_jobs_see_the_batch_cancelled_once_a_winner_returns():
+    fetcher = wallpaper.ConcurrentFetcher(max_workers=2, per_host=2)
+    loser_saw = []
+
+    def job(item, cancel_event):
+        if item == "winner":
+            return item
+        cancel_event.wait(5)
+        loser_saw.append(cancel_event.cancelled)
+        return None
+
+    assert fetcher.first_result(job, ["slow", "winner"]) == "winner"
+    fetcher.shutdown(wait=True)
+    assert loser_saw == [True]
+
+def test_only_one_job_of_a_batch_may_commit():
+    fetcher = wallpaper.ConcurrentFetcher(max_workers=4, per_host=4)
+    barrier = threading.Barrier(4)
+    claims = []
+
+    def job(item, cancel_event):
+        barrier.wait(5)
+        claimed = cancel_event.claim()
+        claims.append(claimed)
+        time.sleep(0.05)
+        return item if claimed else None
+
+    assert fetcher.first_result(job, range(4)) is not None
+    fetcher.shutdown(wait=True)
+    assert sorted(claims) == [False, False, False, True]
+
+def test_claim_on_shared_contexts():
+    shared = wallpaper.ChangeContext()
+    assert shared.claim() and shared.claim()
+    shared.cancel()
+    assert not shared.claim()
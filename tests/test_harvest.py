@@ -0,0 +1,37 @@
+import json
+import urllib.request
+
+import bench_pipeline
+import wallpaper
+
+def listing_requests(base_url):
+    with urllib.request.urlopen(base_url + "/__stats") as response:
+        stats = json.load(response)
+    return sum(count for kind, count in stats["by_kind"].items() if kind in ("listing", "api", "error"))
+
+def test_harvest_fills_every_category(changer, standin):
+    base_url = standin()
+    bench_pipeline.point_sources_at(changer, base_url)
+    harvester = wallpaper.WallpaperHarvester(changer, 3, ["nature", "anime"], workers=4)
+    assert harvester.run()
+    assert harvester.saved("nature") == 3 and harvester.saved("anime") == 3
+
+def test_failing_listing_is_not_paged_through(changer, standin):
+    base_url = standin(broken=["alphacoders", "wallhaven"])
+    bench_pipeline.point_sources_at(changer, base_url)
+    harvester = wallpaper.WallpaperHarvester(changer, 3, ["nature"], workers=4)
+    assert not harvester.run()
+    # One request per source, no walk through max_pages of errors
+    assert listing_requests(base_url) == 2
+    assert harvester.state["pages"] == {}
+
+def test_resumed_harvest_skips_what_it_already_tried(changer, standin):
+    base_url = standin()
+    bench_pipeline.point_sources_at(changer, base_url)
+    first = wallpaper.WallpaperHarvester(changer, 2, ["nature"], workers=2)
+    assert first.run()
+    second = wallpaper.WallpaperHarvester(changer, 4, ["nature"], workers=2)
+    assert second.saved("nature") == 2
+    assert second.run()
+    saved = second.state["categories"]["nature"]["saved"]
+    assert len(saved) == 4 and len(set(saved)) == 4
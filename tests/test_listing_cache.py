@@ -0,0 +1,66 @@
+import time
+
+import wallpaper
+
+SOURCE = "https://example.com/listing"
+
+def make_cache(tmp_path, ttl_seconds=3600):
+    return wallpaper.ListingCache(str(tmp_path / "listing_cache.json"), ttl_seconds)
+
+def test_candidates_are_handed_out_once(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store(SOURCE, ["a", "b", "c"])
+    cache.mark_used(SOURCE, "b")
+    assert cache.remaining(SOURCE) == ["a", "c"]
+
+def test_refetched_listing_keeps_tried_candidates_that_are_still_listed(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store(SOURCE, ["a", "b", "c"])
+    cache.mark_used(SOURCE, "a")
+    cache.mark_used(SOURCE, "c")
+    cache.store(SOURCE, ["a", "b", "d"])
+    assert cache.remaining(SOURCE) == ["b", "d"]
+
+def test_refetched_listing_with_only_tried_candidates_starts_over(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store(SOURCE, ["a", "b"])
+    cache.mark_used(SOURCE, "a")
+    cache.mark_used(SOURCE, "b")
+    assert cache.remaining(SOURCE) == []
+    cache.store(SOURCE, ["a", "b"])
+    assert cache.remaining(SOURCE) == ["a", "b"]
+
+def test_revalidated_listing_starts_over_once_used_up(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store(SOURCE, ["a"], etag='"v1"')
+    cache.mark_used(SOURCE, "a")
+    cache.revalidated(SOURCE)
+    assert cache.remaining(SOURCE) == ["a"]
+
+def test_validators(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.validators(SOURCE) == {}
+    cache.store(SOURCE, ["a"], etag='"v1"', last_modified="Sat, 17 Oct 2026 07:00:00 GMT")
+    assert cache.validators(SOURCE) == {
+        "If-None-Match": '"v1"', "If-Modified-Since": "Sat, 17 Oct 2026 07:00:00 GMT"
+    }
+
+def test_freshness_follows_the_ttl(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, ttl_seconds=60)
+    assert not cache.is_fresh(SOURCE)
+    cache.store(SOURCE, ["a"])
+    assert cache.is_fresh(SOURCE)
+    later = time.time() + 61
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert not cache.is_fresh(SOURCE)
+
+def test_survives_a_restart(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store(SOURCE, ["a", "b"])
+    cache.mark_used(SOURCE, "a")
+    cache.save()
+    assert make_cache(tmp_path).remaining(SOURCE) == ["b"]
+
+def test_corrupt_file_gives_an_empty_cache(tmp_path):
+    (tmp_path / "listing_cache.json").write_text("{not json")
+    assert make_cache(tmp_path).remaining(SOURCE) == []
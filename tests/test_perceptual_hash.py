@@ -0,0 +1,69 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+import wallpaper
+from standin_server import generate_image
+
+def jpeg(seed, size=(640, 360)):
+    return Image.open(io.BytesIO(generate_image(seed, size)))
+
+def test_resized_and_reencoded_copy_is_a_near_duplicate():
+    original = jpeg(1)
+    copy = io.BytesIO()
+    original.resize((320, 180)).save(copy, "JPEG", quality=60)
+    index = wallpaper.PerceptualHashIndex(max_distance=6)
+    index.add("original", wallpaper.image_dhash(original))
+    assert index.find_duplicate(wallpaper.image_dhash(Image.open(copy))) == "original"
+
+def test_different_pictures_are_not_duplicates():
+    index = wallpaper.PerceptualHashIndex(max_distance=6)
+    index.add("first", wallpaper.image_dhash(jpeg(1)))
+    assert index.find_duplicate(wallpaper.image_dhash(jpeg(2))) is None
+
+def test_nearest_reports_the_hamming_distance():
+    index = wallpaper.PerceptualHashIndex()
+    assert index.nearest(0) is None
+    index.add("a", 0b1011)
+    index.add("b", 1 << 63)
+    assert index.nearest(0b0001) == ("a", 2)
+    assert index.nearest(1 << 63 | 1) == ("b", 1)
+
+def test_remove_keeps_the_other_entries_findable():
+    index = wallpaper.PerceptualHashIndex(max_distance=0)
+    for number in range(5):
+        index.add(f"key{number}", 1 << number)
+    index.remove("key1")
+    index.remove("missing")
+    assert len(index) == 4
+    assert index.find_duplicate(1 << 1) is None
+    for number in (0, 2, 3, 4):
+        assert index.find_duplicate(1 << number) == f"key{number}"
+
+def test_grows_past_its_initial_capacity():
+    index = wallpaper.PerceptualHashIndex(max_distance=0)
+    hashes = np.random.default_rng(0).integers(0, 2 ** 63, 3000, dtype=np.uint64)
+    for number, phash in enumerate(hashes):
+        index.add(number, int(phash))
+    assert len(index) == 3000
+    assert index.find_duplicate(int(hashes[2999])) == 2999
+
+def test_partial_progressive_jpeg_hashes_close_to_the_whole_file(tmp_path):
+    # Odd seeds are progressive
+    data = generate_image(3, (1920, 1080))
+    path = tmp_path / "partial.jpg"
+    path.write_bytes(data[:len(data) // 3])
+    full = wallpaper.image_dhash(Image.open(io.BytesIO(data)))
+    partial = wallpaper.partial_jpeg_dhash(str(path))
+    assert bin(full ^ partial).count("1") <= 6
+
+def test_progressive_frame_is_read_from_the_first_bytes():
+    progressive = generate_image(3, (1920, 1080))
+    baseline = generate_image(4, (1920, 1080))
+    assert wallpaper.jpeg_is_progressive(progressive[:4096]) is True
+    assert wallpaper.jpeg_is_progressive(baseline[:4096]) is False
+    # Too little to reach the frame header yet
+    assert wallpaper.jpeg_is_progressive(progressive[:1]) is None
+    assert wallpaper.jpeg_is_progressive(progressive[:30]) is None
+    assert wallpaper.jpeg_is_progressive(b"\x89PNG\r\n\x1a\n") is False
@@ -0,0 +1,234 @@
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from PIL import Image
+
+import standin_server
+import wallpaper
+
+class RangeServer:
+    """Serves one image with ETag, Range and If-Range support, and can drop connections mid-way."""
+    def __init__(self, data):
+        self.data = data
+        self.etag = '"v1"'
+        self.drops = 0  # Responses still to cut off after drop_after bytes
+        self.drop_after = 150000
+        self.chunk_delay = 0  # Seconds between 64 KB chunks
+        self.requests = []  # (Range, If-Range) of every image request
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith("/alphacoders/"):
+                    body = f'<img class="img-responsive" src="{server.url("/img/picture.jpg")}">'.encode()
+                    return self.send(200, body, {"Content-Type": "text/html"})
+                server.serve_image(self)
+
+            def send(self, status, body, headers, drop=False):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    for start in range(0, len(body), 65536):
+                        if drop and start >= server.drop_after:
+                            self.close_connection = True
+                            return
+                        self.wfile.write(body[start:start + 65536])
+                        self.wfile.flush()
+                        time.sleep(server.chunk_delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+
+    def serve_image(self, handler):
+        range_header = handler.headers.get("Range")
+        if_range = handler.headers.get("If-Range")
+        self.requests.append((range_header, if_range))
+        headers = {"ETag": self.etag, "Content-Type": "image/jpeg"}
+        match = re.match(r"bytes=(\d+)-(\d*)$", range_header or "")
+        if match and if_range in (None, self.etag):
+            start = int(match.group(1))
+            if start >= len(self.data):
+                headers["Content-Range"] = f"bytes */{len(self.data)}"
+                return handler.send(416, b"", headers)
+            end = min(int(match.group(2) or len(self.data) - 1), len(self.data) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(self.data)}"
+            body = self.data[start:end + 1]
+            status = 206
+        else:
+            body = self.data
+            status = 200
+        # Only full-length bodies are cut off, never the resolution probe
+        drop = self.drops > 0 and len(body) > self.drop_after and end_of(range_header, self.data)
+        if drop:
+            self.drops -= 1
+        handler.send(status, body, headers, drop=drop)
+
+def end_of(range_header, data):
+    """True if a request reads to the end of data."""
+    match = re.match(r"bytes=\d+-(\d*)$", range_header or "")
+    return not match or not match.group(1) or int(match.group(1)) >= len(data) - 1
+
+@pytest.fixture
+def server():
+    server = RangeServer(standin_server.generate_image(7, (3840, 2160)))
+    yield server
+    server.httpd.shutdown()
+
+def part_files(changer):
+    return sorted(name for name in os.listdir(changer.download_dir) if ".part" in name)
+
+def test_complete_download_is_verified_and_named_after_its_hash(server, changer):
+    path = changer.save_image(server.url("/img/picture.jpg"))
+    digest = hashlib.sha256(server.data).hexdigest()
+    assert os.path.basename(path) == digest[:16] + ".jpg"
+    with open(path, 'rb') as f:
+        assert f.read() == server.data
+    assert part_files(changer) == []
+
+def test_dropped_connection_resumes_with_if_range(server, changer):
+    server.drops = 2
+    path = changer.save_image(server.url("/img/picture.jpg"))
+    with open(path, 'rb') as f:
+        assert f.read() == server.data
+    resumed = [request for request in server.requests if request[1]]
+    assert len(resumed) == 2
+    assert all(if_range == '"v1"' and range_header.startswith("bytes=") for range_header, if_range in resumed)
+
+def test_part_kept_when_retries_run_out_is_resumed_next_time(server, changer):
+    changer.config.set("download_resume_attempts", 0)
+    server.drops = 1
+    url = server.url("/img/picture.jpg")
+    assert changer.save_image(url) is None
+    assert changer.candidate_check.resumable
+    assert part_files(changer) == [os.path.basename(changer.part_path(url)), os.path.basename(changer.part_path(url)) + ".json"]
+    kept = os.path.getsize(changer.part_path(url))
+    
+    server.requests.clear()
+    path = changer.save_image(url)
+    with open(path, 'rb') as f:
+        assert f.read() == server.data
+    assert (f"bytes={kept}-", '"v1"') in server.requests
+    assert part_files(changer) == []
+
+def test_changed_file_starts_over(server, changer):
+    changer.config.set("download_resume_attempts", 0)
+    server.drops = 1
+    url = server.url("/img/picture.jpg")
+    assert changer.save_image(url) is None
+    
+    # The server now has a different picture: If-Range no longer matches
+    server.data = standin_server.generate_image(8, (3840, 2160))
+    server.etag = '"v2"'
+    path = changer.save_image(url)
+    assert os.path.basename(path) == hashlib.sha256(server.data).hexdigest()[:16] + ".jpg"
+    with open(path, 'rb') as f:
+        assert f.read() == server.data
+
+def test_part_that_is_already_complete_is_not_fetched_again(server, changer):
+    url = server.url("/img/picture.jpg")
+    part = changer.part_path(url)
+    with open(part, 'wb') as f:
+        f.write(server.data)
+    with open(part + ".json", 'w') as f:
+        json.dump({"url": url, "etag": server.etag, "last_modified": None, "length": len(server.data)}, f)
+    
+    result = changer.download_to_part(url)
+    assert result == (part, hashlib.sha256(server.data).hexdigest(), len(server.data))
+    assert server.requests == [(f"bytes={len(server.data)}-", '"v1"')]
+
+def test_part_is_kept_when_the_deadline_expires(server, changer):
+    server.chunk_delay = 0.2
+    url = server.url("/img/picture.jpg")
+    assert changer.save_image(url, wallpaper.ChangeContext(timeout=0.7)) is None
+    assert changer.candidate_check.resumable
+    assert os.path.getsize(changer.part_path(url)) > 0
+    assert os.path.exists(changer.part_path(url) + ".json")
+
+def test_part_is_deleted_when_cancelled(server, changer):
+    server.chunk_delay = 0.2
+    context = wallpaper.ChangeContext(timeout=30)
+    threading.Timer(0.7, context.cancel).start()
+    assert changer.save_image(server.url("/img/picture.jpg"), context) is None
+    assert not changer.candidate_check.resumable
+    assert part_files(changer) == []
+
+def test_interrupted_candidate_goes_back_into_the_pool(server, changer):
+    changer.config.set("download_resume_attempts", 0)
+    source = server.url("/alphacoders/by_category.php?name=test")
+    changer.wallpaper_sources[changer.config.get("wallpaper_type")] = [source]
+    url = server.url("/img/picture.jpg")
+    
+    server.drops = 1
+    assert changer.download_new_wallpaper() is None
+    assert changer.listing_cache.remaining(source) == [url]
+    
+    server.requests.clear()
+    path = changer.download_new_wallpaper()
+    with open(path, 'rb') as f:
+        assert f.read() == server.data
+    assert any(if_range for _, if_range in server.requests)
+
+def test_stale_parts_are_removed_but_active_ones_kept(changer):
+    old = time.time() - 25 * 3600
+    for url in ("http://example.com/stale.jpg", "http://example.com/active.jpg"):
+        for path in (changer.part_path(url), changer.part_path(url) + ".json"):
+            with open(path, 'wb') as f:
+                f.write(b"x")
+            os.utime(path, (old, old))
+    changer.active_parts.add("http://example.com/active.jpg")
+    changer.remove_partial_downloads()
+    active = os.path.basename(changer.part_path("http://example.com/active.jpg"))
+    assert part_files(changer) == [active, active + ".json"]
+
+@pytest.mark.parametrize("seed, progressive", [(3, True), (4, False)])
+def test_unprobed_download_is_checked_mid_stream_only_when_progressive(changer, seed, progressive):
+    # Listed by the API with its resolution, so no probe to say it's progressive
+    server = RangeServer(standin_server.generate_image(seed, (3840, 2160)))
+    server.chunk_delay = 0.01
+    try:
+        changer.phash_index.add("seen.jpg", wallpaper.image_dhash(
+            Image.open(io.BytesIO(server.data))))
+        checks = []
+        check = changer.is_partial_duplicate
+        changer.is_partial_duplicate = lambda path: checks.append(os.path.getsize(path)) or check(path)
+        assert changer.save_image(server.url("/img/picture.jpg"), probe=False) is None
+        assert server.requests == [(None, None)]
+        if progressive:
+            assert len(checks) == 1 and checks[0] < len(server.data)
+        else:
+            assert checks == []
+    finally:
+        server.httpd.shutdown()
+
+def test_half_written_renditions_are_removed_once_stale(changer):
+    os.makedirs(changer.rendition_dir, exist_ok=True)
+    stale = os.path.join(changer.rendition_dir, "stale.tmp")
+    fresh = os.path.join(changer.rendition_dir, "fresh.tmp")
+    for path in (stale, fresh):
+        with open(path, 'wb') as f:
+            f.write(b"x")
+    old = time.time() - changer.config.get("change_timeout_seconds") - 60
+    os.utime(stale, (old, old))
+    changer.remove_partial_downloads()
+    assert sorted(os.listdir(changer.rendition_dir)) == ["fresh.tmp"]
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+import wallpaper
+
+class FakeConfig:
+    def __init__(self, **values):
+        self.values = values
+
+    def get(self, key):
+        return self.values[key]
+
+class FakeChanger:
+    def __init__(self, frequency_minutes=1, prefetch_lead_seconds=10):
+        self.config = FakeConfig(frequency_minutes=frequency_minutes, prefetch_lead_seconds=prefetch_lead_seconds)
+        self.change_lock = threading.Lock()
+
+class FakeCondition:
+    """Stands in for the scheduler's condition: waiting just moves the fake clock on."""
+    def __init__(self, clock):
+        self.clock = clock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def wait(self, timeout=None):
+        assert timeout is not None, "the scheduler would wait forever"
+        self.clock.now += timeout
+
+    def notify(self):
+        pass
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+def make_scheduler(clock, monkeypatch, **config):
+    scheduler = wallpaper.WallpaperScheduler(FakeChanger(**config))
+    scheduler.condition = FakeCondition(clock)
+    # next_action is driven by hand, not by the scheduler thread
+    monkeypatch.setattr(scheduler, "ensure_thread", lambda: None)
+    scheduler.start()
+    return scheduler
+
+def test_prepares_lead_seconds_before_each_tick(clock, monkeypatch):
+    scheduler = make_scheduler(clock, monkeypatch)
+    assert scheduler.next_action() == "prepare"
+    assert clock.now == 1050
+    assert scheduler.next_action() == "change"
+    assert clock.now == 1060
+    assert scheduler.next_action() == "prepare"
+    assert clock.now == 1110
+
+def test_ticks_missed_while_asleep_are_dropped(clock, monkeypatch):
+    scheduler = make_scheduler(clock, monkeypatch)
+    clock.now += 250
+    assert scheduler.next_action() == "change"
+    # One change for the missed ticks, and the rate keeps its phase
+    assert scheduler.next_change == 1300
+    assert scheduler.next_action() == "prepare"
+    assert clock.now == 1290
+
+def test_manual_change_right_before_a_tick_replaces_it(clock, monkeypatch):
+    scheduler = make_scheduler(clock, monkeypatch)
+    clock.now += 55
+    scheduler.request_change()
+    assert scheduler.next_action() == "change"
+    assert scheduler.next_change == 1120
+
+def test_manual_change_leaves_a_distant_tick_alone(clock, monkeypatch):
+    scheduler = make_scheduler(clock, monkeypatch)
+    clock.now += 10
+    scheduler.request_change()
+    assert scheduler.next_action() == "change"
+    assert scheduler.next_change == 1060
+
+def test_request_is_ignored_while_a_change_runs(clock, monkeypatch):
+    scheduler = make_scheduler(clock, monkeypatch)
+    with scheduler.changer.change_lock:
+        scheduler.request_change()
+    assert not scheduler.change_requested
+
+def test_lead_is_at_most_half_the_interval(clock, monkeypatch):
+    scheduler = make_scheduler(clock, monkeypatch, prefetch_lead_seconds=600)
+    assert scheduler.lead() == 30
+    assert scheduler.next_action() == "prepare"
+    assert clock.now == 1030
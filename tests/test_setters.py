@@ -0,0 +1,93 @@
+import hashlib
+import os
+
+import pytest
+
+import standin_server
+import wallpaper
+
+class FakeSetter:
+    """Setter backend that records the paths it is given, or fails with error."""
+    def __init__(self):
+        self.paths = []
+        self.error = None
+
+    def __call__(self, path):
+        if self.error:
+            raise self.error
+        self.paths.append(path)
+
+@pytest.fixture(autouse=True)
+def fake_setter(monkeypatch):
+    setter = FakeSetter()
+    monkeypatch.setitem(wallpaper.SETTER_BACKENDS, "fake", setter)
+    return setter
+
+@pytest.fixture
+def changer_settings():
+    # Take the wallpaper from the library so no network is needed
+    return {"wallpaper_setter": "fake", "library_policy": "prefer"}
+
+@pytest.fixture
+def no_desktop(monkeypatch):
+    monkeypatch.delenv("XDG_CURRENT_DESKTOP", raising=False)
+    monkeypatch.setattr(wallpaper.shutil, "which", lambda name: None)
+
+def add_to_library(changer):
+    data = standin_server.generate_image(5, (1920, 1080))
+    path = os.path.join(changer.download_dir, "library.jpg")
+    with open(path, 'wb') as f:
+        f.write(data)
+    changer.library.add(path, hashlib.sha256(data).hexdigest(), None, changer.config.get("wallpaper_type"),
+                        1920, 1080, len(data))
+    return path
+
+def last_shown(changer):
+    return changer.library.db.execute("SELECT last_shown FROM wallpapers").fetchone()[0]
+
+def outcomes(changer, stage):
+    return [event["outcome"] for event in changer.metrics.snapshot()["recent"] if event["stage"] == stage]
+
+def test_configured_backend_gets_the_absolute_path(changer, fake_setter):
+    path = add_to_library(changer)
+    changer.run_change()
+    assert changer.setter_name == "fake"
+    assert fake_setter.paths == [os.path.abspath(path)]
+    assert last_shown(changer) is not None
+    assert outcomes(changer, "change") == ["library"]
+
+def test_failing_backend_records_set_failed(changer, fake_setter):
+    add_to_library(changer)
+    fake_setter.error = OSError("no desktop session")
+    changer.run_change()
+    assert outcomes(changer, "set") == ["error"]
+    assert outcomes(changer, "change") == ["set_failed"]
+    assert last_shown(changer) is None
+
+@pytest.mark.parametrize("changer_settings", [{"wallpaper_setter": "", "library_policy": "prefer"}])
+def test_detected_none_setter_reports_not_applied(no_desktop, changer):
+    add_to_library(changer)
+    changer.run_change()
+    assert changer.setter_name == "none"
+    assert outcomes(changer, "set") == ["not_applied"]
+    assert last_shown(changer) is None
+
+@pytest.mark.parametrize("desktop, tools, expected", [
+    ("KDE", [], "kde"),
+    ("ubuntu:GNOME", [], "gnome"),
+    ("Unity", [], "gnome"),
+    ("Budgie:GNOME", [], "gnome"),
+    ("Pantheon", [], "gnome"),
+    ("XFCE", ["gsettings", "qdbus"], "gnome"),
+    ("XFCE", ["qdbus6"], "kde"),
+    ("", [], "none"),
+])
+def test_detect_setter_on_linux(monkeypatch, desktop, tools, expected):
+    monkeypatch.setenv("XDG_CURRENT_DESKTOP", desktop)
+    monkeypatch.setattr(wallpaper.shutil, "which", lambda name: f"/usr/bin/{name}" if name in tools else None)
+    assert wallpaper.detect_setter("Linux") == expected
+
+def test_detect_setter_by_system():
+    assert wallpaper.detect_setter("Windows") == "windows"
+    assert wallpaper.detect_setter("Darwin") == "macos"
+    assert wallpaper.detect_setter("FreeBSD") == "none"
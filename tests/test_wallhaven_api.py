@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import standin_server
+import wallpaper
+
+def api_source(base_url):
+    return f"{base_url}/wallhaven/api/v1/search?q=nature&sorting=random"
+
+def served_size(url):
+    """The size the stand-in serves a full image URL at."""
+    return standin_server.StandinState().image_size("full-" + url.rsplit("/", 1)[-1])
+
+def seed_and_page(url):
+    # Stand-in wallpaper ids are <seed>-<page>-<number>
+    seed, page, _ = url.rsplit("/", 1)[-1][:-len(".jpg")].split("-")
+    return seed, int(page)
+
+def test_parse_drops_small_and_oversized_wallpapers():
+    text = json.dumps({
+        "data": [
+            {"path": "https://w.example/big.jpg", "dimension_x": 3840, "dimension_y": 2160, "file_size": 900},
+            {"path": "https://w.example/small.jpg", "dimension_x": 1280, "dimension_y": 720, "file_size": 100},
+            {"path": "https://w.example/heavy.jpg", "dimension_x": 1920, "dimension_y": 1080, "file_size": 5000},
+            {"dimension_x": 1920, "dimension_y": 1080, "file_size": 100},
+        ],
+        "meta": {"current_page": 1, "last_page": 7, "seed": "abc123"}
+    })
+    assert wallpaper.parse_wallhaven_api(text, 1000) == (["https://w.example/big.jpg"], 7, "abc123")
+    assert wallpaper.parse_wallhaven_api(text)[0] == ["https://w.example/big.jpg", "https://w.example/heavy.jpg"]
+    assert wallpaper.parse_wallhaven_api('{"data": []}') == ([], 1, None)
+
+def test_listed_wallpapers_are_filtered_before_download(changer, standin):
+    source = api_source(standin())
+    candidates = changer.get_api_candidates(source)
+    assert candidates and len(candidates) < standin_server.API_PER_PAGE
+    assert all(served_size(url) != standin_server.THUMB_SIZE for url in candidates)
+
+    # The stand-in estimates file sizes from the resolution; 4K ones are over half a megabyte
+    changer.config.set("max_image_mb", 0.5)
+    changer.listing_cache.entries.clear()
+    candidates = changer.get_api_candidates(source)
+    assert candidates
+    assert all(served_size(url) in ((1920, 1080), (2560, 1440)) for url in candidates)
+
+def test_pages_keep_their_seed_and_start_over_after_the_last(changer, standin):
+    source = api_source(standin())
+    seen = []
+    for _ in range(standin_server.API_LAST_PAGE + 1):
+        candidates = changer.get_api_candidates(source)
+        seen.append({seed_and_page(url) for url in candidates})
+        for url in candidates:
+            changer.listing_cache.mark_used(source, url)
+
+    first_seed = next(iter(seen[0]))[0]
+    for page, pages in enumerate(seen[:-1], 1):
+        assert pages == {(first_seed, page)}
+    (new_seed, page), = seen[-1]
+    assert page == 1 and new_seed != first_seed
+
+def test_api_key_is_sent_as_a_header_and_never_cached(changer, standin):
+    source = api_source(standin(api_key="s3cret-key"))
+    assert changer.get_api_candidates(source) == []
+    with pytest.raises(RuntimeError, match="401"):
+        changer.get_api_candidates(source, raise_on_error=True)
+
+    changer.config.set("wallhaven_api_key", "s3cret-key")
+    assert changer.get_api_candidates(source)
+    with open(changer.listing_cache.cache_file) as f:
+        cached = f.read()
+    assert source in cached
+    assert "s3cret-key" not in cached
@@ -1,19 +1,188 @@
 import os
 import time
 import random
-import requests
 import platform
 import threading
 import ctypes
 import sys
 import json
-from bs4 import BeautifulSoup
-from PIL import Image
+import subprocess
+import functools
+import argparse
+import signal
+import importlib
+import cProfile
+import re
+import sqlite3
+import hashlib
+import itertools
+import tempfile
+import shutil
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+from html import unescape
 from io import BytesIO
-import tkinter as tk
-from tkinter import ttk, messagebox
-import pystray
-from PIL import Image as PilImage
+
+class LazyModule:
+    """Stand-in for a module that is only imported when one of its attributes is used.
+
+    Keeps startup light and lets headless commands run where GUI toolkits
+    can't even be imported.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+requests = LazyModule("requests")
+urllib3_retry = LazyModule("urllib3.util.retry")
+bs4 = LazyModule("bs4")
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
+tk = LazyModule("tkinter")
+ttk = LazyModule("tkinter.ttk")
+messagebox = LazyModule("tkinter.messagebox")
+pystray = LazyModule("pystray")
+PilImage = Image
+
+# Smallest resolution accepted as a wallpaper (HD)
+MIN_WIDTH = 1920
+MIN_HEIGHT = 1080
+
+# Bytes searched for a JPEG's frame header; EXIF blocks come before it
+JPEG_HEADER_MAX = 128 * 1024
+
+# File extension for each image format PIL reports; saved files are named <hash><extension>
+IMAGE_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "BMP": ".bmp"}
+
+# HTML extraction backends. Every page we scrape only needs one attribute from
+# the elements carrying a given class or id, so each backend answers exactly
+# that question: values(html, attr, css_class=None, element_id=None).
+
+def values_soup(html, attr, css_class=None, element_id=None):
+    """Reference backend: build the full BeautifulSoup tree and run a CSS selector."""
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    selector = f"#{element_id}" if element_id else f".{css_class}"
+    return [el[attr] for el in soup.select(selector) if el.get(attr)]
+
+def values_strainer(html, attr, css_class=None, element_id=None):
+    """Only build tree nodes for the matching elements with a SoupStrainer."""
+    if element_id:
+        strainer = bs4.SoupStrainer(id=element_id)
+    else:
+        # The class attribute may still be the raw string while parsing, so
+        # match on its words instead of comparing the whole value
+        strainer = bs4.SoupStrainer(class_=lambda value: value is not None and css_class in value.split())
+    soup = bs4.BeautifulSoup(html, 'html.parser', parse_only=strainer)
+    return [el[attr] for el in soup.find_all(True) if el.get(attr)]
+
+def values_lxml(html, attr, css_class=None, element_id=None):
+    """Parse with lxml's C parser and XPath; falls back to the strainer if lxml is missing."""
+    try:
+        import lxml.html
+    except ImportError:
+        return values_strainer(html, attr, css_class, element_id)
+    if not html.strip():
+        return []
+    tree = lxml.html.fromstring(html)
+    if element_id:
+        elements = tree.xpath("//*[@id=$value]", value=element_id)
+    else:
+        elements = tree.xpath(
+            "//*[contains(concat(' ', normalize-space(@class), ' '), $value)]",
+            value=f" {css_class} "
+        )
+    return [el.get(attr) for el in elements if el.get(attr)]
+
+# Comments and script/style bodies are skipped so markup inside them never matches
+SCAN_PATTERN = re.compile(
+    r"<!--.*?-->|<(script|style)\b[^>]*>.*?</\1\s*>|<[a-zA-Z][^\s/>]*(\s[^>]*)?>",
+    re.DOTALL | re.IGNORECASE
+)
+ATTR_PATTERN = re.compile(r"""([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+)))?""")
+
+def values_scanner(html, attr, css_class=None, element_id=None):
+    """Scan start tags with regular expressions without building any tree."""
+    needle = element_id or css_class
+    values = []
+    for match in SCAN_PATTERN.finditer(html):
+        tag_attrs = match.group(2)
+        # Cheap substring check before parsing the attributes of a tag
+        if not tag_attrs or needle not in tag_attrs or match.group(1):
+            continue
+        attrs = {}
+        for name, dq, sq, bare in ATTR_PATTERN.findall(tag_attrs):
+            name = name.lower()
+            if name not in attrs:
+                attrs[name] = unescape(dq or sq or bare)
+        if element_id:
+            matched = attrs.get("id") == element_id
+        else:
+            matched = css_class in attrs.get("class", "").split()
+        if matched and attrs.get(attr):
+            values.append(attrs[attr])
+            if element_id:
+                break  # ids are unique, like select_one
+    return values
+
+PARSER_BACKENDS = {
+    "scanner": values_scanner,
+    "strainer": values_strainer,
+    "lxml": values_lxml,
+    "soup": values_soup
+}
+
+def extract_alphacoders_listing(html, backend="scanner"):
+    """Return the image URLs on an alphacoders category page."""
+    img_urls = []
+    for img_url in PARSER_BACKENDS[backend](html, "src", css_class="img-responsive"):
+        if not img_url.startswith('http'):
+            img_url = "https:" + img_url
+        img_urls.append(img_url)
+    return img_urls
+
+def extract_wallhaven_listing(html, backend="scanner"):
+    """Return the detail page links on a wallhaven search page."""
+    return PARSER_BACKENDS[backend](html, "href", css_class="preview")
+
+def extract_wallhaven_detail(html, backend="scanner"):
+    """Return the full image URL on a wallhaven detail page, or None."""
+    values = PARSER_BACKENDS[backend](html, "src", element_id="wallpaper")
+    if not values:
+        return None
+    full_img_url = values[0]
+    if not full_img_url.startswith('http'):
+        full_img_url = "https:" + full_img_url
+    return full_img_url
+
+def is_wallhaven_api(source):
+    """Check whether source is a wallhaven JSON API search rather than an HTML page."""
+    return "/api/v1/search" in source
+
+def parse_wallhaven_api(text, max_bytes=None):
+    """Return (image URLs, last page, seed) from a wallhaven API search response.
+
+    Wallpapers smaller than MIN_WIDTH x MIN_HEIGHT or larger than max_bytes
+    are dropped here, before anything is downloaded.
+    """
+    response = json.loads(text)
+    urls = []
+    for wallpaper in response.get("data") or []:
+        if wallpaper.get("dimension_x", 0) < MIN_WIDTH or wallpaper.get("dimension_y", 0) < MIN_HEIGHT:
+            continue
+        if max_bytes and wallpaper.get("file_size", 0) > max_bytes:
+            continue
+        if wallpaper.get("path"):
+            urls.append(wallpaper["path"])
+    meta = response.get("meta") or {}
+    return urls, meta.get("last_page") or 1, meta.get("seed")
 
 class WallpaperChangerConfig:
     def __init__(self, config_file="wallpaper_config.json"):
@@ -22,7 +191,37 @@ class WallpaperChangerConfig:
             "frequency_minutes": 60,  # Default: change every 60 minutes
             "wallpaper_type": "video_games",  # Default: video games
             "run_on_startup": False,
-            "download_dir": "wallpapers"
+            "download_dir": "wallpapers",
+            "max_concurrent_fetches": 8,  # Worker threads shared by all fetches
+            "per_host_connections": 4,  # Simultaneous requests allowed per host
+            "prefetch_count": 2,  # Wallpapers kept ready in the background
+            "prefetch_max_mb": 100,  # Disk budget for the prefetch buffer
+            "prefetch_lead_seconds": 60,  # Start downloading the next wallpaper this long before it is due
+            "connect_timeout": 5,  # Seconds to wait for a connection
+            "read_timeout": 20,  # Seconds to wait for data on an open connection
+            "max_retries": 3,  # Retries on connection errors, 429 and 5xx
+            "retry_backoff": 0.5,  # Base delay in seconds for exponential backoff
+            "download_chunk_kb": 64,  # Read size while streaming images to disk
+            "max_image_mb": 50,  # Abort downloads larger than this
+            "probe_kb": 32,  # Bytes fetched to read the resolution before downloading
+            "bandwidth_limit_kbps": 0,  # Cap on download speed in KB/s, 0 for none
+            "change_timeout_seconds": 120,  # Give up on the network after this long per change
+            "download_resume_attempts": 3,  # Times a dropped download is resumed with a Range request
+            "partial_max_age_hours": 24,  # Delete interrupted .part downloads older than this at startup
+            "wallhaven_api_key": "",  # Optional key for the wallhaven API, sent as X-API-Key
+            "listing_cache_ttl_minutes": 360,  # How long scraped listing pages are trusted
+            "parser_backend": "scanner",  # HTML extraction: scanner, strainer, lxml or soup
+            "library_max_mb": 500,  # Disk budget for downloaded wallpapers
+            "library_policy": "fallback",  # Reuse downloaded wallpapers: never, fallback or prefer
+            "library_repeat_hours": 24,  # Don't show the same wallpaper again within this time
+            "duplicate_max_distance": 6,  # Perceptual hash bits two images may differ by and still match
+            "renditions": True,  # Set a copy scaled to the display instead of the original
+            "display_size": "",  # e.g. "2560x1440"; detected when empty
+            "rendition_quality": 90,  # JPEG quality of the scaled copies
+            "metrics_json_file": "metrics.json",  # Rolling stage statistics; relative to download_dir
+            "metrics_prometheus_file": "metrics.prom",  # Prometheus text format; empty to disable
+            "profile_next_change": "",  # Write a cProfile dump of the next change to this file
+            "wallpaper_setter": ""  # Setter backend (windows, macos, gnome, kde, none); empty detects it
         }
         self.config = self.load_config()
     
@@ -50,37 +249,1542 @@ class WallpaperChangerConfig:
         self.config[key] = value
         self.save_config()
 
+class StageTimer:
+    """One run of a pipeline stage. Code inside the stage may set bytes, retries and outcome."""
+    def __init__(self, stage, source):
+        self.stage = stage
+        self.source = source
+        self.bytes = 0
+        self.retries = 0
+        self.outcome = "ok"
+
+class PipelineMetrics:
+    """Per-stage durations, bytes, retries and outcomes of the change pipeline.
+
+    Totals are kept per (stage, source) next to a rolling list of the most
+    recent stage runs, and can be exported as JSON or in the Prometheus
+    text format.
+    """
+    def __init__(self, max_events=200):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.http_retries = {}
+        self.events = deque(maxlen=max_events)
+        self.local = threading.local()
+
+    def set_source(self, source):
+        """Attribute the stages run by this thread from now on to source.
+
+        A running stage that didn't know its source yet is attributed too.
+        """
+        self.local.source = source
+        timer = self.current()
+        if timer is not None and timer.source == "local" and source:
+            timer.source = source
+
+    @contextmanager
+    def stage(self, name, source=None):
+        """Time the enclosed block as one run of stage name."""
+        timer = StageTimer(name, source or getattr(self.local, "source", None) or "local")
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(timer)
+        started = time.perf_counter()
+        try:
+            yield timer
+        except Exception:
+            timer.outcome = "error"
+            raise
+        finally:
+            stack.pop()
+            self.record(timer, time.perf_counter() - started)
+
+    def current(self):
+        """Return the innermost stage running on this thread, or None."""
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def annotate(self, outcome=None, bytes=0, retries=0):
+        """Add details to the innermost running stage of this thread."""
+        timer = self.current()
+        if timer is None:
+            return
+        if outcome:
+            timer.outcome = outcome
+        timer.bytes += bytes
+        timer.retries += retries
+
+    def record_retries(self, host, count):
+        """Count HTTP retries made against host."""
+        if not count:
+            return
+        with self.lock:
+            self.http_retries[host] = self.http_retries.get(host, 0) + count
+        self.annotate(retries=count)
+
+    def record(self, timer, seconds):
+        with self.lock:
+            totals = self.totals.setdefault((timer.stage, timer.source), {
+                "count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0, "retries": 0, "outcomes": {}
+            })
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+            totals["bytes"] += timer.bytes
+            totals["retries"] += timer.retries
+            totals["outcomes"][timer.outcome] = totals["outcomes"].get(timer.outcome, 0) + 1
+            self.events.append({
+                "time": time.time(), "stage": timer.stage, "source": timer.source,
+                "seconds": round(seconds, 6), "bytes": timer.bytes,
+                "retries": timer.retries, "outcome": timer.outcome
+            })
+
+    def snapshot(self):
+        """Return all totals and recent stage runs as a JSON-serialisable dict."""
+        with self.lock:
+            return {
+                "updated_at": time.time(),
+                "stages": [
+                    dict(totals, stage=stage, source=source, outcomes=dict(totals["outcomes"]))
+                    for (stage, source), totals in sorted(self.totals.items())
+                ],
+                "http_retries": dict(self.http_retries),
+                "recent": list(self.events)
+            }
+
+    def write_json(self, path):
+        write_file_atomically(path, json.dumps(self.snapshot(), indent=4))
+
+    def write_prometheus(self, path):
+        """Write the totals in the Prometheus text format, e.g. for node_exporter's textfile collector."""
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP wallpaper_stage_seconds Time spent in each stage of the wallpaper change pipeline.",
+            "# TYPE wallpaper_stage_seconds summary",
+        ]
+        for item in snapshot["stages"]:
+            labels = f'stage="{item["stage"]}",source="{item["source"]}"'
+            lines.append(f'wallpaper_stage_seconds_sum{{{labels}}} {item["seconds"]:.6f}')
+            lines.append(f'wallpaper_stage_seconds_count{{{labels}}} {item["count"]}')
+        lines += [
+            "# HELP wallpaper_stage_seconds_max Longest single run of each stage.",
+            "# TYPE wallpaper_stage_seconds_max gauge",
+        ]
+        for item in snapshot["stages"]:
+            labels = f'stage="{item["stage"]}",source="{item["source"]}"'
+            lines.append(f'wallpaper_stage_seconds_max{{{labels}}} {item["max_seconds"]:.6f}')
+        lines += [
+            "# HELP wallpaper_stage_bytes_total Bytes transferred by each stage.",
+            "# TYPE wallpaper_stage_bytes_total counter",
+        ]
+        for item in snapshot["stages"]:
+            labels = f'stage="{item["stage"]}",source="{item["source"]}"'
+            lines.append(f'wallpaper_stage_bytes_total{{{labels}}} {item["bytes"]}')
+        lines += [
+            "# HELP wallpaper_stage_outcomes_total Runs of each stage by outcome.",
+            "# TYPE wallpaper_stage_outcomes_total counter",
+        ]
+        for item in snapshot["stages"]:
+            for outcome, count in sorted(item["outcomes"].items()):
+                labels = f'stage="{item["stage"]}",source="{item["source"]}",outcome="{outcome}"'
+                lines.append(f'wallpaper_stage_outcomes_total{{{labels}}} {count}')
+        lines += [
+            "# HELP wallpaper_http_retries_total HTTP retries per host.",
+            "# TYPE wallpaper_http_retries_total counter",
+        ]
+        for host, count in sorted(snapshot["http_retries"].items()):
+            lines.append(f'wallpaper_http_retries_total{{host="{host}"}} {count}')
+        write_file_atomically(path, "\n".join(lines) + "\n")
+
+def timed_stage(name, source=None):
+    """Decorator: run a WallpaperChanger method as pipeline stage name.
+
+    A None result is recorded with the outcome "none" unless the method
+    set another outcome itself.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(name, source) as timer:
+                result = method(self, *args, **kwargs)
+                if result is None and timer.outcome == "ok":
+                    timer.outcome = "none"
+                return result
+        return wrapper
+    return decorator
+
+def write_file_atomically(path, text):
+    """Write text to path through a temp file so readers never see half a file."""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def source_name(source):
+    """Short label for a listing URL, used to group metrics per source."""
+    for name in ("alphacoders", "wallhaven"):
+        if name in source:
+            return name
+    return urlparse(source).netloc
+
+class ChangeCancelled(Exception):
+    """Raised when the change a request belongs to was cancelled or ran out of time."""
+
+class ChangeContext:
+    """Cancellation and an overall deadline shared by all the work of one change.
+
+    Works where a threading.Event is expected: it counts as set once it is
+    cancelled or its deadline has passed. Children share the deadline and
+    are cancelled with their parent.
+    """
+    def __init__(self, timeout=None, deadline=None, single_winner=False):
+        self.event = threading.Event()
+        self.deadline = deadline
+        self.single_winner = single_winner  # Jobs race and only one may commit its result
+        self.claimed = False
+        if timeout:
+            deadline = time.monotonic() + timeout
+            self.deadline = deadline if self.deadline is None else min(self.deadline, deadline)
+        self.children = []
+        self.lock = threading.Lock()
+
+    def child(self, single_winner=False):
+        """Return a context that is cancelled with this one but can also be cancelled alone."""
+        child = ChangeContext(deadline=self.deadline, single_winner=single_winner)
+        with self.lock:
+            self.children.append(child)
+        if self.event.is_set():
+            child.cancel()
+        return child
+
+    def cancel(self):
+        self.event.set()
+        with self.lock:
+            children = list(self.children)
+        for child in children:
+            child.cancel()
+
+    set = cancel
+
+    @property
+    def cancelled(self):
+        """True if cancel() was called, as opposed to running out of time."""
+        return self.event.is_set()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def is_set(self):
+        return self.event.is_set() or self.expired()
+
+    def claim(self):
+        """Return True if the caller may commit its result.
+
+        Never once the context is set, and for a single_winner context only
+        for the first caller, so jobs finishing at the same time don't all commit.
+        """
+        with self.lock:
+            if self.is_set() or (self.single_winner and self.claimed):
+                return False
+            self.claimed = True
+            return True
+
+    def remaining(self):
+        """Seconds until the deadline, or None without one."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def wait(self, timeout=None):
+        """Sleep up to timeout seconds, waking early on cancel or at the deadline; return is_set()."""
+        remaining = self.remaining()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        self.event.wait(timeout)
+        return self.is_set()
+
+# Change context of the request running on each thread, for interruptible retry backoff
+request_context = threading.local()
+
+@functools.lru_cache(maxsize=None)
+def capped_retry_class():
+    """Return the CappedRetry class, defined on first use so urllib3 loads lazily."""
+    class CappedRetry(urllib3_retry.Retry):
+        """Retry policy that honours Retry-After but never sleeps longer than max_retry_after."""
+        max_retry_after = 60
+
+        def get_retry_after(self, response):
+            retry_after = super().get_retry_after(response)
+            if retry_after is None:
+                return None
+            return min(retry_after, self.max_retry_after)
+
+        def sleep(self, response=None):
+            """Wait before retrying, giving up as soon as the change is cancelled."""
+            cancel_event = getattr(request_context, "cancel_event", None)
+            if cancel_event is None:
+                return super().sleep(response)
+            seconds = None
+            if response is not None and self.respect_retry_after_header:
+                seconds = self.get_retry_after(response)
+            if seconds is None:
+                seconds = self.get_backoff_time()
+            if cancel_event.wait(seconds):
+                raise ChangeCancelled("cancelled while waiting to retry")
+    return CappedRetry
+
+class HttpClient:
+    """Shared HTTP session with per-host connection pools, timeouts and retries."""
+    def __init__(self, pool_size=4, connect_timeout=5, read_timeout=20, retries=3, backoff=0.5, metrics=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.metrics = metrics
+        self.session = requests.Session()
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+        })
+        
+        # Retry idempotent GETs on connection errors, throttling and server errors
+        # with exponential backoff, waiting as long as Retry-After asks for
+        retry = capped_retry_class()(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        # One pool per host, sized to the number of requests we allow per host
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url, cancel_event=None, **kwargs):
+        """GET a URL over a pooled connection with the default timeouts.
+
+        With a ChangeContext the timeouts are capped by its deadline, and
+        retries stop once it is cancelled.
+        """
+        timeout = kwargs.pop("timeout", self.timeout)
+        if cancel_event is not None:
+            if cancel_event.is_set():
+                raise ChangeCancelled(f"cancelled before fetching {url}")
+            remaining = cancel_event.remaining()
+            if remaining is not None:
+                if remaining <= 0:
+                    # The deadline passed since is_set(); requests rejects a zero timeout
+                    raise ChangeCancelled(f"out of time before fetching {url}")
+                timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+        request_context.cancel_event = cancel_event
+        try:
+            response = self.session.get(url, timeout=timeout, **kwargs)
+        finally:
+            request_context.cancel_event = None
+        if self.metrics is not None:
+            retries = getattr(response.raw, "retries", None)
+            if retries is not None:
+                self.metrics.record_retries(urlparse(url).netloc, len(retries.history))
+        return response
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
+
+class ConcurrentFetcher:
+    """Bounded thread pool that runs fetch jobs with a per-host concurrency limit."""
+    def __init__(self, max_workers=8, per_host=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fetch")
+        self.per_host = per_host
+        self.host_slots = {}
+        self.lock = threading.Lock()
+
+    def host_slot(self, url):
+        """Return the semaphore limiting concurrent requests to the host of url."""
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_slots[host]
+
+    def first_result(self, job, items, parent=None, window=None):
+        """Run job(item, cancel_event) for the items in turn and return the first truthy result.
+
+        At most window jobs (per_host by default) are queued at a time, so a
+        long list of items doesn't hold up jobs other callers queue meanwhile.
+        As soon as one job succeeds, the cancel event is set and no more items
+        are started. Jobs that are already running should check the event and
+        give up early. The event is a child of parent, a ChangeContext, if one
+        is given.
+        """
+        cancel_event = parent.child(single_winner=True) if parent is not None else ChangeContext(single_winner=True)
+        window = window or self.per_host
+        items = iter(items)
+        pending = {self.executor.submit(self._run_job, job, item, cancel_event)
+                   for item in itertools.islice(items, window)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Fetch job failed: {e}")
+                        continue
+                    if result:
+                        return result
+                # Keep the window full with the next items
+                if not cancel_event.is_set():
+                    for item in itertools.islice(items, window - len(pending)):
+                        pending.add(self.executor.submit(self._run_job, job, item, cancel_event))
+            return None
+        finally:
+            cancel_event.set()
+            for future in pending:
+                future.cancel()
+
+    def _run_job(self, job, item, cancel_event):
+        """Run a single job unless the batch has already been cancelled."""
+        if cancel_event.is_set():
+            return None
+        return job(item, cancel_event)
+
+    def shutdown(self, wait=False):
+        """Stop accepting jobs and drop the queued ones."""
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+class ListingCache:
+    """Disk-backed cache of the candidate URLs scraped from each listing page.
+
+    Each source keeps its candidates, the ones already tried, and the ETag /
+    Last-Modified validators used to revalidate the page once the TTL expires.
+    """
+    def __init__(self, cache_file, ttl_seconds):
+        self.cache_file = cache_file
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # Harvest threads may save at the same time
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"Error loading listing cache: {e}")
+        return {}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries)
+        try:
+            # Write to a temp file first so a crash can't leave a truncated cache
+            with self.save_lock:
+                temp_file = self.cache_file + ".tmp"
+                with open(temp_file, 'w') as f:
+                    f.write(data)
+                os.replace(temp_file, self.cache_file)
+        except Exception as e:
+            print(f"Error saving listing cache: {e}")
+
+    def remaining(self, source):
+        """Return the candidates of source that haven't been tried yet."""
+        with self.lock:
+            entry = self.entries.get(source)
+            if not entry:
+                return []
+            used = set(entry["used"])
+            return [url for url in entry["candidates"] if url not in used]
+
+    def is_fresh(self, source):
+        """Check whether the cached listing of source is younger than the TTL."""
+        with self.lock:
+            entry = self.entries.get(source)
+            return bool(entry) and time.time() - entry["fetched_at"] < self.ttl_seconds
+
+    def validators(self, source):
+        """Return conditional request headers for revalidating source."""
+        with self.lock:
+            entry = self.entries.get(source) or {}
+            headers = {}
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+            return headers
+
+    def store(self, source, candidates, etag=None, last_modified=None, page=None, last_page=None, seed=None):
+        """Replace the candidates of source, remembering which were already tried.
+
+        Paged sources also keep the page the candidates came from, the
+        number of pages and the seed that keeps random results stable.
+        """
+        with self.lock:
+            old_used = set(self.entries.get(source, {}).get("used", []))
+            if old_used >= set(candidates):
+                old_used = set()  # Nothing new on the page; start over
+            self.entries[source] = {
+                "fetched_at": time.time(),
+                "etag": etag,
+                "last_modified": last_modified,
+                "candidates": candidates,
+                "used": [url for url in candidates if url in old_used],
+                "page": page,
+                "last_page": last_page,
+                "seed": seed
+            }
+
+    def next_page(self, source):
+        """Return the (page, seed) of a paged source to fetch next.
+
+        Moves on to the following page once every candidate was tried, and
+        starts over with a new seed after the last one.
+        """
+        with self.lock:
+            entry = self.entries.get(source)
+            if not entry or not entry.get("page"):
+                return 1, None
+            used = set(entry["used"])
+            exhausted = all(url in used for url in entry["candidates"])
+            if exhausted and entry["page"] < (entry.get("last_page") or 1):
+                return entry["page"] + 1, entry.get("seed")
+            return 1, None
+
+    def revalidated(self, source):
+        """Mark an unchanged listing (304) as fresh, starting over if its pool ran dry."""
+        with self.lock:
+            entry = self.entries[source]
+            entry["fetched_at"] = time.time()
+            if set(entry["used"]) >= set(entry["candidates"]):
+                entry["used"] = []
+
+    def mark_used(self, source, url):
+        """Record that a candidate of source has been tried."""
+        with self.lock:
+            entry = self.entries.get(source)
+            if entry and url not in entry["used"]:
+                entry["used"].append(url)
+
+    def unmark_used(self, source, url):
+        """Hand a candidate of source out again, e.g. after its download was interrupted."""
+        with self.lock:
+            entry = self.entries.get(source)
+            if entry and url in entry["used"]:
+                entry["used"].remove(url)
+
+def image_dhash(img):
+    """Return the 64-bit difference hash of a PIL image.
+
+    The image is shrunk to 9x8 grayscale and each bit records whether a
+    pixel is brighter than its right-hand neighbour, so re-encodes and
+    resizes of the same artwork land within a few bits of each other.
+    """
+    if img.format == "JPEG":
+        # Let libjpeg decode at 1/8 scale; the hash only needs 9x8 pixels
+        img.draft("L", (img.width // 8, img.height // 8))
+    pixels = np.asarray(img.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def file_dhash(path):
+    """Return the difference hash of an image file."""
+    with Image.open(path) as img:
+        return image_dhash(img)
+
+def jpeg_is_progressive(head):
+    """Tell from the first bytes of a file whether it is a progressive JPEG.
+
+    Walks the marker segments up to the frame header: SOF2 (and the other
+    progressive SOF markers) means progressive. Returns None while head is
+    too short to tell, and False for anything that isn't a JPEG.
+    """
+    if len(head) < 2:
+        return None
+    if head[:2] != b"\xff\xd8":
+        return False
+    position = 2
+    while position + 4 <= len(head):
+        if head[position] != 0xFF:
+            return False
+        marker = head[position + 1]
+        if marker == 0xFF:
+            position += 1  # Fill byte
+            continue
+        if marker in (0xC2, 0xC6, 0xCA, 0xCE):
+            return True
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC) or marker == 0xDA:
+            return False  # Sequential frame, or scan data without a frame header
+        position += 2 + int.from_bytes(head[position + 2:position + 4], "big")
+    return None
+
+def partial_jpeg_dhash(path):
+    """Hash a progressive JPEG that is still downloading.
+
+    The first scans of a progressive JPEG already cover the whole picture
+    at low detail, so closing the data with an end-of-image marker gives a
+    blurry but complete image that is good enough for a difference hash.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    with Image.open(BytesIO(data + b"\xff\xd9")) as img:
+        return image_dhash(img)
+
+@functools.lru_cache(maxsize=None)
+def popcount_table():
+    """Bits set in each byte value, for numpy versions without bitwise_count."""
+    return np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+class PerceptualHashIndex:
+    """Difference hashes of the library in a NumPy array, searched by Hamming distance."""
+    def __init__(self, max_distance=6):
+        self.max_distance = max_distance
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        self.keys = []
+        self.positions = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, phash):
+        """Store the hash of the wallpaper identified by key."""
+        with self.lock:
+            if key in self.positions:
+                self.hashes[self.positions[key]] = phash
+                return
+            if len(self.keys) == len(self.hashes):
+                self.hashes = np.concatenate([self.hashes, np.zeros(len(self.hashes), dtype=np.uint64)])
+            self.hashes[len(self.keys)] = phash
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+
+    def remove(self, key):
+        """Forget the hash of key by moving the last entry into its slot."""
+        with self.lock:
+            position = self.positions.pop(key, None)
+            if position is None:
+                return
+            last_key = self.keys.pop()
+            if last_key != key:
+                self.hashes[position] = self.hashes[len(self.keys)]
+                self.keys[position] = last_key
+                self.positions[last_key] = position
+
+    def nearest(self, phash):
+        """Return (key, distance) of the closest stored hash, or None if the index is empty."""
+        with self.lock:
+            count = len(self.keys)
+            if not count:
+                return None
+            xor = self.hashes[:count] ^ np.uint64(phash)
+            if hasattr(np, "bitwise_count"):
+                distances = np.bitwise_count(xor)
+            else:
+                distances = popcount_table()[xor.view(np.uint8)].reshape(count, 8).sum(axis=1)
+            best = int(np.argmin(distances))
+            return self.keys[best], int(distances[best])
+
+    def find_duplicate(self, phash):
+        """Return the key of a stored near-duplicate of phash, or None."""
+        match = self.nearest(phash)
+        if match and match[1] <= self.max_distance:
+            return match[0]
+        return None
+
+# GetDeviceCaps indexes of the desktop size in physical pixels
+DESKTOPVERTRES = 117
+DESKTOPHORZRES = 118
+
+def detect_display_size(system):
+    """Return the (width, height) of the primary display in pixels, or None if unknown."""
+    try:
+        if system == "Windows":
+            # Ask the device context for physical pixels; GetSystemMetrics
+            # reports scaled ones unless the whole process is made DPI aware
+            user32 = ctypes.windll.user32
+            gdi32 = ctypes.windll.gdi32
+            hdc = user32.GetDC(0)
+            try:
+                return gdi32.GetDeviceCaps(hdc, DESKTOPHORZRES), gdi32.GetDeviceCaps(hdc, DESKTOPVERTRES)
+            finally:
+                user32.ReleaseDC(0, hdc)
+        
+        elif system == "Darwin":
+            output = subprocess.run(
+                ["system_profiler", "SPDisplaysDataType"],
+                capture_output=True, text=True, timeout=10
+            ).stdout
+            match = re.search(r"Resolution:\s*(\d+)\s*x\s*(\d+)", output)
+            if match:
+                return int(match.group(1)), int(match.group(2))
+        
+        elif system == "Linux":
+            output = subprocess.run(
+                ["xrandr", "--current"], capture_output=True, text=True, timeout=10
+            ).stdout
+            # Prefer the primary output, then any connected one
+            match = (re.search(r" connected primary (\d+)x(\d+)\+", output)
+                     or re.search(r" connected (\d+)x(\d+)\+", output))
+            if match:
+                return int(match.group(1)), int(match.group(2))
+    except Exception as e:
+        print(f"Could not detect display size: {e}")
+    return None
+
+def run_setter_command(argv, timeout=15):
+    """Run a setter program directly, without a shell; raise if it fails."""
+    result = subprocess.run(argv, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"{argv[0]} exited with {result.returncode}: {result.stderr.strip()}")
+
+def set_wallpaper_windows(path):
+    """Set the wallpaper through the Win32 API."""
+    # SPI_SETDESKWALLPAPER, SPIF_UPDATEINIFILE | SPIF_SENDCHANGE
+    if not ctypes.windll.user32.SystemParametersInfoW(20, 0, path, 3):
+        raise ctypes.WinError()
+
+def set_wallpaper_macos(path):
+    """Set the wallpaper with AppleScript."""
+    quoted = path.replace("\\", "\\\\").replace('"', '\\"')
+    run_setter_command([
+        "osascript", "-e",
+        f'tell application "System Events" to set desktop picture to POSIX file "{quoted}"'
+    ])
+
+def set_wallpaper_gnome(path):
+    """Set the wallpaper on GNOME and desktops sharing its settings schema."""
+    uri = "file://" + path
+    run_setter_command(["gsettings", "set", "org.gnome.desktop.background", "picture-uri", uri])
+
+KDE_SCRIPT = """
+var allDesktops = desktops();
+for (i = 0; i < allDesktops.length; i++) {
+    d = allDesktops[i];
+    d.wallpaperPlugin = "org.kde.image";
+    d.currentConfigGroup = Array("Wallpaper", "org.kde.image", "General");
+    d.writeConfig("Image", %s);
+}
+"""
+
+def set_wallpaper_kde(path):
+    """Set the wallpaper of every Plasma desktop through plasmashell's scripting API."""
+    qdbus = shutil.which("qdbus") or shutil.which("qdbus6") or "qdbus"
+    run_setter_command([
+        qdbus, "org.kde.plasmashell", "/PlasmaShell", "org.kde.PlasmaShell.evaluateScript",
+        KDE_SCRIPT % json.dumps("file://" + path)
+    ])
+
+def set_wallpaper_none(path):
+    """Don't touch the desktop, e.g. headless or in benchmarks."""
+
+# Name -> function(absolute image path) that sets the wallpaper or raises
+SETTER_BACKENDS = {
+    "windows": set_wallpaper_windows,
+    "macos": set_wallpaper_macos,
+    "gnome": set_wallpaper_gnome,
+    "kde": set_wallpaper_kde,
+    "none": set_wallpaper_none
+}
+
+def detect_setter(system):
+    """Return the name of the setter backend for the running desktop."""
+    if system == "Windows":
+        return "windows"
+    if system == "Darwin":
+        return "macos"
+    if system == "Linux":
+        desktop = os.environ.get("XDG_CURRENT_DESKTOP", "").upper()
+        if "KDE" in desktop:
+            return "kde"
+        if any(name in desktop for name in ("GNOME", "UNITY", "BUDGIE", "PANTHEON")):
+            return "gnome"
+        # Unknown desktop: use whichever tool is installed
+        if shutil.which("gsettings"):
+            return "gnome"
+        if shutil.which("qdbus") or shutil.which("qdbus6"):
+            return "kde"
+    return "none"
+
+def make_rendition(source_path, target_path, size, quality=90):
+    """Scale and center-crop an image to exactly size and save it as a JPEG."""
+    with Image.open(source_path) as img:
+        if img.format == "JPEG":
+            # Decode at the smallest 1/2, 1/4 or 1/8 scale still covering the display
+            img.draft("RGB", size)
+        rendition = ImageOps.fit(img.convert("RGB"), size, Image.LANCZOS)
+    # Unique temp name: two threads may render the same wallpaper at once
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(target_path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            rendition.save(f, "JPEG", quality=quality, optimize=True)
+        os.replace(temp_path, target_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+class WallpaperLibrary:
+    """SQLite index of downloaded wallpapers keyed by content hash.
+
+    Wallpapers stay on disk after they have been shown and are evicted
+    least recently shown first once the library grows past its byte budget.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        is_new = not os.path.exists(db_file)
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS wallpapers (
+                sha256 TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                source_url TEXT,
+                category TEXT,
+                width INTEGER,
+                height INTEGER,
+                bytes INTEGER,
+                added_at REAL,
+                last_shown REAL,
+                phash INTEGER
+            )
+        """)
+        try:
+            # Libraries created before perceptual hashing
+            self.db.execute("ALTER TABLE wallpapers ADD COLUMN phash INTEGER")
+        except sqlite3.OperationalError:
+            pass
+        self.db.execute("CREATE INDEX IF NOT EXISTS wallpapers_path ON wallpapers (path)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS wallpapers_category ON wallpapers (category, last_shown)")
+        self.db.commit()
+        self.is_new = is_new
+
+    def add(self, path, sha256, source_url, category, width, height, size, phash=None):
+        """Record a wallpaper that has just been saved to path."""
+        if phash is not None and phash >= 1 << 63:
+            phash -= 1 << 64  # SQLite integers are signed
+        with self.lock:
+            # A file saved under an existing name replaced the old content
+            self.db.execute("DELETE FROM wallpapers WHERE path = ? AND sha256 != ?", (path, sha256))
+            self.db.execute(
+                "INSERT OR REPLACE INTO wallpapers VALUES (?, ?, ?, ?, ?, ?, ?, ?, "
+                "(SELECT last_shown FROM wallpapers WHERE sha256 = ?), ?)",
+                (sha256, path, source_url, category, width, height, size, time.time(), sha256, phash)
+            )
+            self.db.commit()
+
+    def phashes(self):
+        """Return (sha256, phash) for every wallpaper that has a perceptual hash."""
+        with self.lock:
+            rows = self.db.execute("SELECT sha256, phash FROM wallpapers WHERE phash IS NOT NULL").fetchall()
+        return [(sha256, phash & ((1 << 64) - 1)) for sha256, phash in rows]
+
+    def find(self, sha256):
+        """Return the path of the wallpaper with this content hash, or None."""
+        with self.lock:
+            row = self.db.execute("SELECT path FROM wallpapers WHERE sha256 = ?", (sha256,)).fetchone()
+        if row and os.path.exists(row[0]):
+            return row[0]
+        return None
+
+    def mark_shown(self, path):
+        """Record that the wallpaper at path was just set as the desktop background."""
+        with self.lock:
+            self.db.execute("UPDATE wallpapers SET last_shown = ? WHERE path = ?", (time.time(), path))
+            self.db.commit()
+
+    def pick(self, category, min_age_seconds=0, exclude=()):
+        """Return the least recently shown wallpaper of category, or None.
+
+        Wallpapers shown less than min_age_seconds ago and paths in exclude
+        are skipped. Never-shown wallpapers come first.
+        """
+        cutoff = time.time() - min_age_seconds
+        exclude = {os.path.abspath(path) for path in exclude}
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path FROM wallpapers WHERE category = ? "
+                "AND (last_shown IS NULL OR last_shown <= ?) "
+                "ORDER BY last_shown IS NOT NULL, last_shown, added_at",
+                (category, cutoff)
+            ).fetchall()
+        for (path,) in rows:
+            if os.path.abspath(path) not in exclude and os.path.exists(path):
+                return path
+        return None
+
+    def count(self):
+        """Return the number of indexed wallpapers."""
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM wallpapers").fetchone()[0]
+
+    def total_bytes(self):
+        """Return the combined size of all indexed wallpapers."""
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM wallpapers").fetchone()[0]
+
+    def evict(self, max_bytes, keep=()):
+        """Delete least recently shown wallpapers until the library fits in max_bytes.
+
+        Returns (sha256, path) of every evicted wallpaper.
+        """
+        keep = {os.path.abspath(path) for path in keep}
+        evicted = []
+        total = self.total_bytes()
+        if total <= max_bytes:
+            return evicted
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT sha256, path, bytes FROM wallpapers "
+                "ORDER BY COALESCE(last_shown, added_at)"
+            ).fetchall()
+        for sha256, path, size in rows:
+            if total <= max_bytes:
+                break
+            if os.path.abspath(path) in keep:
+                continue  # Skip the current and prefetched wallpapers
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                print(f"Removed old wallpaper: {path}")
+            except Exception as e:
+                print(f"Failed to remove {path}: {e}")
+                continue
+            with self.lock:
+                self.db.execute("DELETE FROM wallpapers WHERE sha256 = ?", (sha256,))
+                self.db.commit()
+            evicted.append((sha256, path))
+            total -= size or 0
+        return evicted
+
+    def adopt_directory(self, directory, category):
+        """Index image files already in directory, e.g. from before the library existed."""
+        for name in os.listdir(directory):
+            if not name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.webp')):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                with Image.open(path) as img:
+                    width, height = img.size
+                    phash = image_dhash(img)
+                self.add(path, digest.hexdigest(), None, category, width, height, os.path.getsize(path), phash)
+            except Exception as e:
+                print(f"Could not index {path}: {e}")
+
+class SourceHealth:
+    """Success rate, latency and usable candidate rate of every source, kept across restarts.
+
+    choose() samples each source's success rate from a Beta distribution
+    (Thompson sampling) and favours fast sources whose listings hold many
+    usable (big enough) images, so healthy ones are picked more often
+    while the others still get an occasional try. After
+    failure_threshold failures in a row a source's circuit opens and it is
+    skipped for a backoff that doubles with every further failure.
+    """
+    decay = 0.9  # Weight of the history at each update, so old results fade
+    failure_threshold = 3
+    base_backoff = 60
+    max_backoff = 3600
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.sources = self.load()
+
+    def load(self):
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"Error loading source health: {e}")
+        return {}
+
+    def save(self):
+        """Write the stats. Called with self.lock held."""
+        try:
+            write_file_atomically(self.state_file, json.dumps(self.sources, indent=4))
+        except Exception as e:
+            print(f"Error saving source health: {e}")
+
+    def entry(self, source):
+        return self.sources.setdefault(source, {
+            "attempts": 0,
+            "successes": 0.0,  # Decayed counts
+            "failures": 0.0,
+            "latency": None,  # Moving average of seconds per attempt
+            "usable": None,  # Moving average of the fraction of tried candidates that were big enough
+            "consecutive_failures": 0,
+            "open_until": 0  # time.time() until which the circuit is open
+        })
+
+    def choose(self, sources):
+        """Pick the source to try next."""
+        now = time.time()
+        with self.lock:
+            closed = [source for source in sources if self.entry(source)["open_until"] <= now]
+            if not closed:
+                # Every circuit is open: try the one that would reopen first
+                return min(sources, key=lambda source: self.entry(source)["open_until"])
+            
+            def score(source):
+                stats = self.entry(source)
+                success_rate = random.betavariate(stats["successes"] + 1, stats["failures"] + 1)
+                # Halve the score of a source that takes 10 s per attempt
+                score = success_rate / (1 + (stats["latency"] or 0) / 10)
+                if stats.get("usable") is not None:
+                    # Thumbnails on the listing cost a probe each before a wallpaper turns up
+                    score *= (1 + stats["usable"]) / 2
+                return score
+            return max(closed, key=score)
+
+    def record(self, source, success, seconds, usable=None):
+        """Account for one attempt at source; usable is the fraction of its tried candidates that were big enough."""
+        with self.lock:
+            stats = self.entry(source)
+            stats["attempts"] += 1
+            stats["successes"] = stats["successes"] * self.decay + (1 if success else 0)
+            stats["failures"] = stats["failures"] * self.decay + (0 if success else 1)
+            stats["latency"] = seconds if stats["latency"] is None else 0.7 * stats["latency"] + 0.3 * seconds
+            if usable is not None:
+                stats["usable"] = usable if stats.get("usable") is None else 0.7 * stats["usable"] + 0.3 * usable
+            if success:
+                stats["consecutive_failures"] = 0
+                stats["open_until"] = 0
+            else:
+                stats["consecutive_failures"] += 1
+                excess = stats["consecutive_failures"] - self.failure_threshold
+                if excess >= 0:
+                    backoff = min(self.max_backoff, self.base_backoff * 2 ** excess)
+                    stats["open_until"] = time.time() + backoff
+                    print(f"{source_name(source)} failed {stats['consecutive_failures']} times in a row, "
+                          f"skipping {source} for {backoff / 60:.0f} minutes")
+            self.save()
+
+class WallpaperPrefetcher:
+    """Keep a few validated wallpapers on disk so a change only has to set one."""
+    def __init__(self, changer, size=2, max_bytes=100 * 1024 * 1024):
+        self.changer = changer
+        self.size = size
+        self.max_bytes = max_bytes
+        self.buffer = deque()  # (path, size in bytes)
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.running = False
+        self.thread = None
+        self.active_downloads = set()  # ChangeContexts of the downloads in progress
+
+    def start(self):
+        """Start the background refill thread if it is not already running."""
+        self.running = True
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.refill_loop, daemon=True)
+            self.thread.start()
+        self.wake_event.set()
+
+    def stop(self):
+        """Stop refilling the buffer and abort the download in progress."""
+        self.running = False
+        self.cancel_current()
+        self.wake_event.set()
+
+    def cancel_current(self):
+        """Abort every download in progress."""
+        with self.lock:
+            contexts = list(self.active_downloads)
+        for context in contexts:
+            context.cancel()
+
+    def is_refilling(self):
+        """Check whether the refill thread is running, and so downloading whenever the buffer is short."""
+        return self.running and self.thread is not None and self.thread.is_alive()
+
+    def wake(self):
+        """Have the refill thread check the buffer now, skipping any failure backoff."""
+        self.wake_event.set()
+
+    def buffered_bytes(self):
+        """Return the total size of the buffered wallpapers."""
+        with self.lock:
+            return sum(size for _, size in self.buffer)
+
+    def buffered_paths(self):
+        """Return the paths of the buffered wallpapers."""
+        with self.lock:
+            return [path for path, _ in self.buffer]
+
+    def is_full(self):
+        """Check whether the buffer has reached its count or byte budget."""
+        with self.lock:
+            total = sum(size for _, size in self.buffer)
+            return len(self.buffer) >= self.size or total >= self.max_bytes
+
+    def take(self):
+        """Pop a ready wallpaper, or return None if the buffer is empty."""
+        with self.lock:
+            while self.buffer:
+                path, _ = self.buffer.popleft()
+                if os.path.exists(path):
+                    break
+            else:
+                path = None
+        # Start downloading a replacement right away
+        self.wake_event.set()
+        return path
+
+    def invalidate(self):
+        """Drop every buffered wallpaper, e.g. after the wallpaper type changed.
+
+        The files stay in the library under their own category.
+        """
+        with self.lock:
+            self.generation += 1
+            self.buffer.clear()
+        # Whatever is downloading now is for the old type too
+        self.cancel_current()
+        self.wake_event.set()
+
+    def refill_loop(self):
+        """Download wallpapers until the buffer is full, then wait to be woken up."""
+        failures = 0
+        while self.running:
+            if self.is_full():
+                self.wake_event.wait()
+                self.wake_event.clear()
+                continue
+            
+            if not self.fill_one():
+                # Back off a little so a dead network doesn't spin the thread
+                failures += 1
+                self.wake_event.wait(min(300, 5 * 2 ** failures))
+                self.wake_event.clear()
+                continue
+            failures = 0
+
+    def fill_one(self):
+        """Download one wallpaper into the buffer, even past its count; return True on success."""
+        with self.lock:
+            generation = self.generation
+        
+        context = ChangeContext(self.changer.config.get("change_timeout_seconds"))
+        with self.lock:
+            self.active_downloads.add(context)
+        try:
+            path = self.changer.download_new_wallpaper(context)
+        finally:
+            with self.lock:
+                self.active_downloads.discard(context)
+        if not path or not os.path.exists(path):
+            return False
+        
+        with self.lock:
+            # Skip it if the wallpaper type changed while it was downloading
+            # or the same image was picked twice
+            if generation == self.generation and all(path != buffered for buffered, _ in self.buffer):
+                self.buffer.append((path, os.path.getsize(path)))
+                print(f"Prefetched wallpaper: {path} ({len(self.buffer)}/{self.size} ready)")
+        return True
+
+class WallpaperScheduler:
+    """Run every wallpaper change on one thread, at a fixed rate on the monotonic clock.
+
+    Manual requests and timer ticks that overlap are merged into one change,
+    and the next wallpaper is downloaded lead seconds before it is due.
+    """
+    def __init__(self, changer):
+        self.changer = changer
+        self.condition = threading.Condition()
+        self.ticking = False
+        self.next_change = None  # time.monotonic() deadline of the next tick
+        self.prepared_for = None  # Deadline the next wallpaper was already prepared for
+        self.change_requested = False
+        self.thread = None
+
+    def interval(self):
+        return max(1, self.changer.config.get("frequency_minutes")) * 60
+
+    def lead(self):
+        """Seconds before a tick to start preparing its wallpaper."""
+        return min(self.changer.config.get("prefetch_lead_seconds"), self.interval() / 2)
+
+    def ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def start(self):
+        """Start ticking; the first tick is one interval from now."""
+        with self.condition:
+            self.ticking = True
+            self.next_change = time.monotonic() + self.interval()
+            self.prepared_for = None
+            self.ensure_thread()
+            self.condition.notify()
+        print(f"Next wallpaper change scheduled in {self.changer.config.get('frequency_minutes')} minutes")
+
+    def next_change_time(self):
+        """Return the wall-clock time of the next tick, or None when stopped."""
+        with self.condition:
+            if not self.ticking:
+                return None
+            return time.time() + self.next_change - time.monotonic()
+
+    def stop(self):
+        """Stop ticking. A change that is already running is left to the caller to cancel."""
+        with self.condition:
+            self.ticking = False
+            self.change_requested = False
+            self.condition.notify()
+
+    def request_change(self):
+        """Change the wallpaper as soon as possible, unless a change is already running."""
+        if self.changer.change_lock.locked():
+            print("A wallpaper change is already running")
+            return
+        with self.condition:
+            self.change_requested = True
+            self.ensure_thread()
+            self.condition.notify()
+
+    def next_action(self):
+        """Wait until there is something to do and return "change" or "prepare"."""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                due = self.ticking and now >= self.next_change
+                if due or self.change_requested:
+                    if due:
+                        # Fixed rate: ticks missed while busy or asleep are dropped, not queued
+                        while self.next_change <= now:
+                            self.next_change += self.interval()
+                    elif self.ticking and self.next_change - now <= self.lead():
+                        # A manual change right before a tick stands in for it
+                        self.next_change += self.interval()
+                    self.change_requested = False
+                    return "change"
+                
+                timeout = None
+                if self.ticking:
+                    prepare_at = self.next_change - self.lead()
+                    if self.prepared_for != self.next_change and now >= prepare_at:
+                        self.prepared_for = self.next_change
+                        return "prepare"
+                    timeout = self.next_change - now
+                    if self.prepared_for != self.next_change:
+                        timeout = prepare_at - now
+                self.condition.wait(timeout)
+
+    def run(self):
+        """Scheduler thread: the only place timer and manual changes run."""
+        while True:
+            action = self.next_action()
+            try:
+                if action == "prepare":
+                    self.changer.prepare_next_wallpaper()
+                else:
+                    self.changer.change_wallpaper()
+            except Exception as e:
+                print(f"Error in scheduled wallpaper {action}: {e}")
+
+class BandwidthLimiter:
+    """Token bucket shared by all download threads, limiting bytes per second."""
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second  # Allow a one second burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes, cancel_event=None):
+        """Account for nbytes just received, sleeping if we are ahead of the rate.
+
+        The sleep ends early if cancel_event is set.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt lets every thread pay for its own chunk in turn
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            if cancel_event is not None:
+                cancel_event.wait(wait)
+            else:
+                time.sleep(wait)
+
+class WallpaperHarvester:
+    """Download count wallpapers for every category at once, resumably.
+
+    Progress is kept in a state file: wallpapers saved per category, every
+    candidate URL already tried and the listing page reached per source.
+    An interrupted harvest continues from there and never fetches a URL
+    twice, apart from resuming a download whose connection gave out.
+    """
+    max_pages = 50  # Listing pages tried per source before giving up on it
+
+    def __init__(self, changer, count, categories=None, workers=8, state_file=None, restart=False):
+        self.changer = changer
+        self.count = count
+        self.categories = categories or list(changer.wallpaper_sources)
+        self.workers = workers
+        self.state_file = state_file or os.path.join(changer.download_dir, "harvest_state.json")
+        self.stop_event = ChangeContext()  # Cancels every download of the harvest
+        self.lock = threading.Lock()
+        self.state = {"categories": {}, "pages": {}}
+        if not restart:
+            self.load()
+        for category in self.categories:
+            self.state["categories"].setdefault(category, {"saved": [], "fetched": []})
+        self.fetched = {
+            category: set(self.state["categories"][category]["fetched"]) for category in self.categories
+        }
+        self.requeued = {}  # URL -> times its interrupted download was put back this run
+        self.started = time.monotonic()
+        self.saved_this_run = 0
+        self.bytes_saved = 0
+
+    def load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                self.state = json.load(f)
+            print(f"Resuming harvest from {self.state_file}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error loading harvest state, starting over: {e}")
+
+    def save(self):
+        """Write the state file. Called with self.lock held."""
+        try:
+            write_file_atomically(self.state_file, json.dumps(self.state))
+        except Exception as e:
+            print(f"Error saving harvest state: {e}")
+
+    def saved(self, category):
+        with self.lock:
+            return len(self.state["categories"][category]["saved"])
+
+    def total_saved(self):
+        with self.lock:
+            return sum(len(self.state["categories"][category]["saved"]) for category in self.categories)
+
+    def stop(self):
+        """Stop starting new downloads and cancel the running ones."""
+        self.stop_event.set()
+
+    def run(self):
+        """Harvest until every category has count wallpapers, runs out of candidates or is stopped."""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            with ThreadPoolExecutor(max_workers=len(self.categories)) as producers:
+                futures = [producers.submit(self.harvest_category, category, pool) for category in self.categories]
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Error harvesting: {e}")
+        self.changer.listing_cache.save()
+        
+        for category in self.categories:
+            print(f"{category}: {self.saved(category)}/{self.count}")
+        library_bytes = self.changer.library.total_bytes()
+        if library_bytes > self.changer.config.get("library_max_mb") * 1024 * 1024:
+            print(f"The library holds {library_bytes / (1024 * 1024):.0f} MB, more than library_max_mb: "
+                  "raise it or the next change will evict harvested wallpapers")
+        return all(self.saved(category) >= self.count for category in self.categories)
+
+    def harvest_category(self, category, pool):
+        """Feed the download pool with new candidates for category until it has enough."""
+        while not self.stop_event.is_set() and self.saved(category) < self.count:
+            candidates = self.new_candidates(category)
+            if not candidates:
+                print(f"{category}: no new candidates left")
+                return
+            # Never run more downloads than wallpapers still missing, so the
+            # category doesn't overshoot and the others get their share of the pool
+            pending = deque(candidates)
+            running = set()
+            while pending or running:
+                needed = self.count - self.saved(category)
+                while pending and len(running) < needed and not self.stop_event.is_set():
+                    listing, url = pending.popleft()
+                    running.add(pool.submit(self.harvest_one, category, listing, url))
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for job in done:
+                    job.result()
+
+    def new_candidates(self, category):
+        """Return (listing, url) pairs for category that were never tried, paging through listings."""
+        candidates = []
+        for source in self.changer.wallpaper_sources.get(category, []):
+            # The listing cache pages the API source by itself as its candidates are used up
+            api = is_wallhaven_api(source)
+            pages_seen = 0
+            while not self.stop_event.is_set():
+                with self.lock:
+                    page = 1 if api else self.state["pages"].get(source, 1)
+                url = source if page == 1 else f"{source}&page={page}"
+                try:
+                    self.changer.metrics.set_source(source_name(source))
+                    listed = self.changer.get_candidates(url, self.stop_event, raise_on_error=True)
+                except Exception as e:
+                    # Failing or throttling: leave the page alone and try the source next round
+                    print(f"Error fetching listing {url}: {e}")
+                    break
+                new = [candidate for candidate in listed if candidate not in self.fetched[category]]
+                if new:
+                    candidates.extend((url, candidate) for candidate in new)
+                    break
+                pages_seen += 1
+                if (pages_seen if api else page) >= self.max_pages:
+                    break
+                # Everything on this page was tried: move on to the next one
+                if api:
+                    for candidate in listed:
+                        self.changer.listing_cache.mark_used(url, candidate)
+                else:
+                    with self.lock:
+                        self.state["pages"][source] = page + 1
+        random.shuffle(candidates)
+        return candidates
+
+    def harvest_one(self, category, listing, url):
+        """Try one candidate from a listing page and record the outcome."""
+        if self.stop_event.is_set() or self.saved(category) >= self.count:
+            return
+        self.changer.metrics.set_source(source_name(listing))
+        self.changer.candidate_check.resumable = False
+        path = self.changer.candidate_job(listing)(url, self.stop_event, category=category)
+        if self.stop_event.is_set() and not path:
+            return  # Cancelled, not tried: keep it for the next run
+        if self.changer.candidate_check.resumable:
+            with self.lock:
+                self.requeued[url] = self.requeued.get(url, 0) + 1
+                retry = self.requeued[url] <= self.changer.config.get("download_resume_attempts")
+            if retry:
+                return  # Interrupted: the next round of candidates resumes it
+        
+        # Regular changes shouldn't try it again either
+        self.changer.listing_cache.mark_used(listing, url)
+        with self.lock:
+            entry = self.state["categories"][category]
+            self.fetched[category].add(url)
+            entry["fetched"].append(url)
+            if path:
+                entry["saved"].append(path)
+                self.saved_this_run += 1
+                self.bytes_saved += os.path.getsize(path)
+            self.save()
+        if path:
+            self.report(category)
+
+    def report(self, category):
+        """Print overall progress after a wallpaper was saved."""
+        done = self.total_saved()
+        total = self.count * len(self.categories)
+        elapsed = time.monotonic() - self.started
+        rate = self.bytes_saved / elapsed if elapsed else 0
+        per_wallpaper = elapsed / self.saved_this_run if self.saved_this_run else 0
+        print(f"Harvest {done}/{total} ({category} {self.saved(category)}/{self.count}), "
+              f"{self.bytes_saved / (1024 * 1024):.1f} MB at {rate / 1024:.0f} KB/s, "
+              f"about {per_wallpaper * max(0, total - done) / 60:.1f} min left")
+
 class WallpaperChanger:
-    def __init__(self):
+    def __init__(self, config_file="wallpaper_config.json"):
         """Initialize the wallpaper changer."""
-        self.config = WallpaperChangerConfig()
+        self.config = WallpaperChangerConfig(config_file)
         self.download_dir = self.config.get("download_dir")
         self.system = platform.system()
+        self.setter_name = self.config.get("wallpaper_setter") or detect_setter(self.system)
+        if self.setter_name not in SETTER_BACKENDS:
+            print(f"Unknown wallpaper setter {self.setter_name}, detecting one")
+            self.setter_name = detect_setter(self.system)
+        self.setter = SETTER_BACKENDS[self.setter_name]
+        print(f"Using the {self.setter_name} wallpaper setter")
+        if self.setter_name == "none" and self.config.get("wallpaper_setter") != "none":
+            print("Warning: no wallpaper setter found for this desktop, wallpapers will be downloaded "
+                  "but not applied. Set wallpaper_setter in the config to choose one.")
         self.create_download_directory()
         self.running = False
-        self.timer = None
+        self.change_lock = threading.Lock()  # One change at a time, whoever triggers it
+        self.active_change = None  # ChangeContext of the running change
+        self.current_wallpaper = None
+        self.last_change_at = None
+        self.metrics = PipelineMetrics()
+        self.profile_next_change = self.config.get("profile_next_change") or None
+        self.http = HttpClient(
+            pool_size=self.config.get("per_host_connections"),
+            connect_timeout=self.config.get("connect_timeout"),
+            read_timeout=self.config.get("read_timeout"),
+            retries=self.config.get("max_retries"),
+            backoff=self.config.get("retry_backoff"),
+            metrics=self.metrics
+        )
+        self.fetcher = ConcurrentFetcher(
+            max_workers=self.config.get("max_concurrent_fetches"),
+            per_host=self.config.get("per_host_connections")
+        )
+        # URLs whose .part file a thread is writing to right now
+        self.active_parts = set()
+        self.parts_lock = threading.Lock()
+        self.bandwidth = None
+        if self.config.get("bandwidth_limit_kbps"):
+            self.bandwidth = BandwidthLimiter(self.config.get("bandwidth_limit_kbps") * 1024)
+        self.parser_backend = self.config.get("parser_backend")
+        if self.parser_backend not in PARSER_BACKENDS:
+            print(f"Unknown parser backend {self.parser_backend}, using scanner")
+            self.parser_backend = "scanner"
+        self.listing_cache = ListingCache(
+            os.path.join(self.download_dir, "listing_cache.json"),
+            ttl_seconds=self.config.get("listing_cache_ttl_minutes") * 60
+        )
+        self.source_health = SourceHealth(os.path.join(self.download_dir, "source_health.json"))
+        # What became of the candidate each thread last tried: usable (big enough,
+        # for the source's yield) and resumable (its .part was kept to finish later)
+        self.candidate_check = threading.local()
+        self.candidate_check_lock = threading.Lock()
+        self.library = WallpaperLibrary(os.path.join(self.download_dir, "library.db"))
+        if self.library.is_new:
+            # Keep the wallpapers downloaded before the library existed
+            self.library.adopt_directory(self.download_dir, self.config.get("wallpaper_type"))
+        self.rendition_dir = os.path.join(self.download_dir, "renditions")
+        self.remove_partial_downloads()
+        self.display_size = None
+        if self.config.get("renditions"):
+            self.display_size = self.get_display_size()
+        self.phash_index = PerceptualHashIndex(self.config.get("duplicate_max_distance"))
+        for sha256, phash in self.library.phashes():
+            self.phash_index.add(sha256, phash)
+        self.prefetcher = WallpaperPrefetcher(
+            self,
+            size=self.config.get("prefetch_count"),
+            max_bytes=self.config.get("prefetch_max_mb") * 1024 * 1024
+        )
+        self.scheduler = WallpaperScheduler(self)
         
         # Wallpaper sources for different types
         self.wallpaper_sources = {
             "video_games": [
                 "https://wall.alphacoders.com/by_category.php?id=3&name=Video+Game+Wallpapers",
-                "https://wallhaven.cc/search?q=video+games&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
+                "https://wallhaven.cc/api/v1/search?q=video+games&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
             ],
             "nature": [
                 "https://wall.alphacoders.com/by_category.php?id=15&name=Nature+Wallpapers",
-                "https://wallhaven.cc/search?q=nature&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
+                "https://wallhaven.cc/api/v1/search?q=nature&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
             ],
             "abstract": [
                 "https://wall.alphacoders.com/by_category.php?id=7&name=Abstract+Wallpapers",
-                "https://wallhaven.cc/search?q=abstract&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
+                "https://wallhaven.cc/api/v1/search?q=abstract&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
             ],
             "anime": [
                 "https://wall.alphacoders.com/by_category.php?id=1&name=Anime+Wallpapers",
-                "https://wallhaven.cc/search?q=anime&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
+                "https://wallhaven.cc/api/v1/search?q=anime&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
             ],
             "sci_fi": [
                 "https://wall.alphacoders.com/by_category.php?id=30&name=Sci+Fi+Wallpapers",
-                "https://wallhaven.cc/search?q=sci-fi&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
+                "https://wallhaven.cc/api/v1/search?q=sci-fi&categories=111&purity=100&resolutions=1920x1080,2560x1440,3840x2160&sorting=random"
             ]
         }
 
@@ -95,61 +1799,65 @@ class WallpaperChanger:
         wallpaper_type = self.config.get("wallpaper_type")
         return self.wallpaper_sources.get(wallpaper_type, self.wallpaper_sources["video_games"])
 
-    def download_new_wallpaper(self):
-        """Download a single new wallpaper and return its path."""
+    @timed_stage("download_new_wallpaper")
+    def download_new_wallpaper(self, cancel_event=None):
+        """Download a single new wallpaper and return its path.
+
+        All fetches stop when cancel_event, a ChangeContext, is cancelled or
+        expires; without one the download gets change_timeout_seconds.
+        """
         print("Downloading a new wallpaper...")
+        if cancel_event is None:
+            cancel_event = ChangeContext(self.config.get("change_timeout_seconds"))
         
         # Get sources for current wallpaper type
         sources = self.get_sources_for_current_type()
         
-        # Randomly select a source
-        source = random.choice(sources)
+        # Favour the sources that have been working well
+        source = self.source_health.choose(sources)
+        self.metrics.set_source(source_name(source))
+        started = time.monotonic()
+        usable = None  # Fraction of the tried candidates that were big enough
+        file_path = None
         
         try:
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-            response = requests.get(source, headers=headers)
-            soup = BeautifulSoup(response.text, 'html.parser')
+            candidates = self.get_candidates(source, cancel_event)
             
-            # Find image links based on the source
-            img_urls = []
+            # Candidates are tried in parallel and the first valid wallpaper wins
+            job = self.candidate_job(source)
+            if job is None:
+                candidates = []
             
-            if "alphacoders" in source:
-                img_elements = soup.select('.img-responsive')
-                for img in img_elements:
-                    if img.get('src'):
-                        img_url = img['src']
-                        if not img_url.startswith('http'):
-                            img_url = "https:" + img_url
-                        img_urls.append(img_url)
+            # Shuffle the list to try different images if one fails,
+            # but finish interrupted downloads first
+            random.shuffle(candidates)
+            candidates.sort(key=lambda url: not os.path.exists(self.part_path(url)))
             
-            elif "wallhaven" in source:
-                img_elements = soup.select('.preview')
-                for img in img_elements:
-                    img_url = img.get('href')
-                    if img_url:
-                        try:
-                            # For wallhaven, we need to get the actual image URL from the detail page
-                            detail_response = requests.get(img_url, headers=headers)
-                            detail_soup = BeautifulSoup(detail_response.text, 'html.parser')
-                            wallpaper = detail_soup.select_one('#wallpaper')
-                            if wallpaper and wallpaper.get('src'):
-                                full_img_url = wallpaper['src']
-                                if not full_img_url.startswith('http'):
-                                    full_img_url = "https:" + full_img_url
-                                img_urls.append(full_img_url)
-                        except Exception as e:
-                            print(f"Error processing wallhaven image: {e}")
-                            continue
+            # Candidates found big enough or too small, for the source's yield
+            checked = {True: 0, False: 0}
             
-            # Pick a random image URL from the collected ones
-            if img_urls:
-                # Shuffle the list to try different images if one fails
-                random.shuffle(img_urls)
-                
-                for url in img_urls:
-                    file_path = self.save_image(url)
-                    if file_path:
-                        return file_path
+            def try_candidate(url, cancel_event):
+                self.metrics.set_source(source_name(source))
+                # Whatever happens, don't hand out this candidate again
+                self.listing_cache.mark_used(source, url)
+                self.candidate_check.usable = None
+                self.candidate_check.resumable = False
+                path = job(url, cancel_event)
+                if self.candidate_check.usable is not None:
+                    with self.candidate_check_lock:
+                        checked[self.candidate_check.usable] += 1
+                if self.candidate_check.resumable:
+                    # Put it back so a later change resumes the download
+                    self.listing_cache.unmark_used(source, url)
+                return path
+            
+            file_path = self.fetcher.first_result(try_candidate, candidates, parent=cancel_event)
+            if checked[True] + checked[False]:
+                usable = checked[True] / (checked[True] + checked[False])
+            self.listing_cache.save()
+            
+            if file_path:
+                return file_path
             
             print("Failed to find suitable wallpaper from this source.")
             return None
@@ -157,110 +1865,723 @@ class WallpaperChanger:
         except Exception as e:
             print(f"Error fetching from source {source}: {e}")
             return None
+        finally:
+            # Being cancelled says nothing about the source; running out of time does
+            if not cancel_event.cancelled:
+                self.source_health.record(source, bool(file_path), time.monotonic() - started, usable)
 
-    def save_image(self, url):
-        """Save an image from URL to the download directory and return the file path."""
+    @timed_stage("listing")
+    def get_candidates(self, source, cancel_event=None, raise_on_error=False):
+        """Return untried candidate URLs for source, scraping the listing only when needed.
+
+        A listing that answers with an error status leaves the cached
+        candidates in place, or raises RuntimeError with raise_on_error.
+        """
+        if self.listing_cache.is_fresh(source):
+            candidates = self.listing_cache.remaining(source)
+            if candidates:
+                self.metrics.annotate(outcome="cached")
+                return candidates
+        
+        if is_wallhaven_api(source):
+            return self.get_api_candidates(source, cancel_event, raise_on_error)
+        
+        # Expired or used up: revalidate the listing page
+        response = self.fetch(source, cancel_event, headers=self.listing_cache.validators(source))
+        self.metrics.annotate(bytes=len(response.content))
+        if response.status_code == 304:
+            print(f"Listing unchanged: {source}")
+            self.metrics.annotate(outcome="not_modified")
+            self.listing_cache.revalidated(source)
+        elif response.status_code != 200:
+            # Keep whatever we had; an error page has no candidates
+            print(f"Failed to fetch listing {source}. Status code: {response.status_code}")
+            self.metrics.annotate(outcome=f"http_{response.status_code}")
+            if raise_on_error:
+                raise RuntimeError(f"listing answered {response.status_code}")
+        else:
+            self.listing_cache.store(
+                source,
+                self.extract_candidates(source, response.text),
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified")
+            )
+        self.listing_cache.save()
+        return self.listing_cache.remaining(source)
+
+    def get_api_candidates(self, source, cancel_event=None, raise_on_error=False):
+        """Fetch the next page of a wallhaven API search and return its untried image URLs."""
+        page, seed = self.listing_cache.next_page(source)
+        params = {"page": page}
+        if seed:
+            params["seed"] = seed
+        headers = {}
+        if self.config.get("wallhaven_api_key"):
+            # A header keeps the key out of URLs, logs and the listing cache
+            headers["X-API-Key"] = self.config.get("wallhaven_api_key")
+        
+        response = self.fetch(source, cancel_event, params=params, headers=headers)
+        self.metrics.annotate(bytes=len(response.content))
+        if response.status_code != 200:
+            print(f"Failed to fetch listing {source}. Status code: {response.status_code}")
+            self.metrics.annotate(outcome=f"http_{response.status_code}")
+            if raise_on_error:
+                raise RuntimeError(f"listing answered {response.status_code}")
+            return self.listing_cache.remaining(source)
+        
+        candidates, last_page, seed = parse_wallhaven_api(
+            response.text, self.config.get("max_image_mb") * 1024 * 1024
+        )
+        self.listing_cache.store(source, candidates, page=page, last_page=last_page, seed=seed)
+        self.listing_cache.save()
+        return self.listing_cache.remaining(source)
+
+    def candidate_job(self, source):
+        """Return the function that turns a candidate of source into a saved wallpaper."""
+        if is_wallhaven_api(source):
+            # Image URLs whose resolution the API already reported
+            return functools.partial(self.save_image, probe=False)
+        if "alphacoders" in source:
+            # The candidates are image URLs
+            return self.save_image
+        if "wallhaven" in source:
+            # For wallhaven, the actual image URL is on each detail page.
+            return self.fetch_wallhaven_image
+        return None
+
+    def extract_candidates(self, source, html):
+        """Find the candidate URLs on a listing page."""
+        if "alphacoders" in source:
+            return extract_alphacoders_listing(html, self.parser_backend)
+        elif "wallhaven" in source:
+            # Links to the detail pages that hold the full image
+            return extract_wallhaven_listing(html, self.parser_backend)
+        return []
+
+    def fetch(self, url, cancel_event=None, **kwargs):
+        """GET a URL while holding a connection slot for its host."""
+        with self.fetcher.host_slot(url):
+            return self.http.get(url, cancel_event, **kwargs)
+
+    def fetch_wallhaven_image(self, detail_url, cancel_event=None, category=None):
+        """Resolve a wallhaven detail page to its full image and save it."""
+        full_img_url = self.resolve_wallhaven_detail(detail_url, cancel_event)
+        if not full_img_url:
+            return None
+        
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        return self.save_image(full_img_url, cancel_event, category)
+
+    @timed_stage("detail")
+    def resolve_wallhaven_detail(self, detail_url, cancel_event=None):
+        """Return the full image URL from a wallhaven detail page, or None."""
         try:
+            detail_response = self.fetch(detail_url, cancel_event)
+            self.metrics.annotate(bytes=len(detail_response.content))
+            return extract_wallhaven_detail(detail_response.text, self.parser_backend)
+        except Exception as e:
+            print(f"Error processing wallhaven image: {e}")
+            self.metrics.annotate(outcome="error")
+            return None
+
+    @timed_stage("save_image")
+    def save_image(self, url, cancel_event=None, category=None, probe=True):
+        """Save an image from URL to the download directory and return the file path.
+
+        With probe False the resolution isn't read ahead of the download,
+        for URLs whose listing already reported it.
+        """
+        temp_path = None
+        try:
+            if cancel_event is not None and cancel_event.is_set():
+                self.metrics.annotate(outcome="cancelled")
+                return None
             print(f"Downloading: {url}")
-            response = requests.get(url, stream=True)
-            if response.status_code == 200:
-                # Extract filename from URL or create one
-                filename = os.path.basename(url)
-                if not filename or '.' not in filename:
-                    filename = f"wallpaper_{random.randint(1000, 9999)}.jpg"
-                
-                # Ensure the image is a valid image and has high resolution
-                img = Image.open(BytesIO(response.content))
+            
+            # Check the resolution from the image header before paying for the full file
+            probe = self.probe_image(url, cancel_event) if probe else None
+            if probe:
+                width, height = probe
+                self.candidate_check.usable = width >= MIN_WIDTH and height >= MIN_HEIGHT
+                if not self.candidate_check.usable:
+                    print(f"Skipping low-resolution image: {width}x{height}")
+                    self.metrics.annotate(outcome="low_resolution")
+                    return None
+            
+            if cancel_event is not None and cancel_event.is_set():
+                self.metrics.annotate(outcome="cancelled")
+                return None
+            
+            # Stream the image to its .part file, resuming an earlier attempt
+            download = self.download_to_part(url, cancel_event, self.is_partial_duplicate)
+            if not download:
+                return None
+            temp_path, digest, size = download
+            
+            # Another candidate may have won while this one was downloading
+            if cancel_event is not None and cancel_event.is_set():
+                self.metrics.annotate(outcome="cancelled")
+                return None
+            
+            # The same image may be listed under another URL
+            existing = self.library.find(digest)
+            if existing:
+                print(f"Skipping duplicate of {existing}")
+                self.metrics.annotate(outcome="duplicate")
+                return None
+            
+            # ... or re-encoded and resized
+            with self.metrics.stage("validate"):
+                phash = file_dhash(temp_path)
+                duplicate = self.phash_index.find_duplicate(phash)
+            if duplicate:
+                print(f"Skipping near-duplicate of {duplicate}")
+                self.metrics.annotate(outcome="near_duplicate")
+                return None
+            
+            # Ensure the image is a valid image and has high resolution.
+            # Image.open only reads the header, the pixels stay on disk.
+            with Image.open(temp_path) as img:
                 width, height = img.size
+                image_format = img.format
+            
+            # Only save if the resolution is high enough (at least HD)
+            self.candidate_check.usable = width >= MIN_WIDTH and height >= MIN_HEIGHT
+            if self.candidate_check.usable:
+                # Of the candidates racing for one change, only the first gets this far
+                if cancel_event is not None and not cancel_event.claim():
+                    self.metrics.annotate(outcome="cancelled")
+                    return None
                 
-                # Only save if the resolution is high enough (at least HD)
-                if width >= 1920 and height >= 1080:
-                    file_path = os.path.join(self.download_dir, filename)
-                    
-                    # Save the image
-                    with open(file_path, 'wb') as f:
-                        f.write(response.content)
-                    print(f"Saved: {file_path}")
-                    return file_path
-                else:
-                    print(f"Skipping low-resolution image: {width}x{height}")
+                # Name the file after its content, so the same image always lands in the same place
+                extension = IMAGE_EXTENSIONS.get(image_format) or os.path.splitext(urlparse(url).path)[1] or ".jpg"
+                file_path = os.path.join(self.download_dir, f"{digest[:16]}{extension.lower()}")
+                
+                # Move the verified file into place in one step
+                os.replace(temp_path, file_path)
+                temp_path = None
+                self.library.add(
+                    file_path, digest, url, category or self.config.get("wallpaper_type"),
+                    width, height, size, phash
+                )
+                self.phash_index.add(digest, phash)
+                print(f"Saved: {file_path}")
+                
+                # Scale it for the display now, off the path of the next change
+                self.get_rendition(file_path)
+                return file_path
             else:
-                print(f"Failed to download image. Status code: {response.status_code}")
+                print(f"Skipping low-resolution image: {width}x{height}")
+                self.metrics.annotate(outcome="low_resolution")
+        except ChangeCancelled:
+            self.metrics.annotate(outcome="cancelled")
         except Exception as e:
             print(f"Error saving image: {e}")
+            self.metrics.annotate(outcome="error")
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
         return None
 
-    def change_wallpaper(self):
-        """Download a new wallpaper and set it as desktop background."""
-        # Download a new wallpaper
-        wallpaper_path = self.download_new_wallpaper()
+    @timed_stage("probe")
+    def probe_image(self, url, cancel_event=None):
+        """Read (width, height) from the first few KB of an image, or None if unknown.
+
+        Asks for a byte range and stops reading after probe_kb even if the
+        server ignores it. PIL only needs the header to know the size.
+        """
+        probe_bytes = self.config.get("probe_kb") * 1024
+        try:
+            with self.fetcher.host_slot(url):
+                response = self.http.get(url, cancel_event, stream=True,
+                                         headers={"Range": f"bytes=0-{probe_bytes - 1}"})
+                try:
+                    if response.status_code not in (200, 206):
+                        return None
+                    data = bytearray()
+                    for chunk in response.iter_content(chunk_size=8192):
+                        self.throttle(len(chunk), cancel_event)
+                        data.extend(chunk)
+                        if len(data) >= probe_bytes:
+                            break
+                finally:
+                    response.close()
+            self.metrics.annotate(bytes=len(data))
+            with Image.open(BytesIO(data)) as img:
+                width, height = img.size
+                return width, height
+        except ChangeCancelled:
+            self.metrics.annotate(outcome="cancelled")
+            return None
+        except Exception as e:
+            # Header didn't fit in the probe or the server misbehaved;
+            # fall back to checking the full download
+            print(f"Could not probe {url}: {e}")
+            self.metrics.annotate(outcome="unknown")
+            return None
+
+    def is_partial_duplicate(self, temp_path):
+        """Check a partly downloaded progressive JPEG against the perceptual hash index."""
+        try:
+            duplicate = self.phash_index.find_duplicate(partial_jpeg_dhash(temp_path))
+        except Exception:
+            return False  # Not enough data to decode yet
+        if duplicate:
+            print(f"Aborting download of near-duplicate of {duplicate}")
+            self.metrics.annotate(outcome="near_duplicate")
+            return True
+        return False
+
+    def part_path(self, url):
+        """Return the .part file a download of url is written to, the same for every attempt."""
+        return os.path.join(self.download_dir, f".{hashlib.sha1(url.encode()).hexdigest()[:20]}.part")
+
+    @timed_stage("download")
+    def download_to_part(self, url, cancel_event=None, checkpoint=None):
+        """Stream url into its .part file and return (part path, sha256 hex digest, size).
+
+        A .part left by an earlier attempt is resumed with a Range request,
+        guarded by If-Range so a changed file starts over, and a connection
+        that drops mid-way is resumed up to download_resume_attempts times.
+        The returned file has the length the server announced. Bytes are
+        hashed as they arrive, so memory use is bounded by the chunk size.
+        
+        Returns None if the download fails, is cancelled or exceeds
+        max_image_mb. The .part is only kept when the network gave out,
+        so a later attempt can resume it.
+        
+        If given, checkpoint(part_path) is called once a quarter of a
+        progressive JPEG has arrived, which is enough to hash it, and the
+        download is abandoned when it returns True. Whether it is progressive
+        is read from the first bytes of the download itself.
+        """
+        with self.parts_lock:
+            if url in self.active_parts:
+                print(f"Already downloading {url}")
+                return None
+            self.active_parts.add(url)
+        try:
+            return self.resume_part(url, cancel_event, checkpoint)
+        finally:
+            with self.parts_lock:
+                self.active_parts.discard(url)
+
+    def resume_part(self, url, cancel_event, checkpoint):
+        """Body of download_to_part, run while holding the URL's .part file."""
+        chunk_size = self.config.get("download_chunk_kb") * 1024
+        max_bytes = self.config.get("max_image_mb") * 1024 * 1024
+        part_path = self.part_path(url)
+        meta_path = part_path + ".json"
+        
+        # Pick up what an interrupted attempt left behind
+        meta = {}
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        digest = hashlib.sha256()
+        size = 0
+        head = bytearray()  # Start of the file, to find the JPEG frame type
+        if meta.get("url") == url and os.path.exists(part_path):
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    if not size:
+                        head = bytearray(block[:JPEG_HEADER_MAX])
+                    digest.update(block)
+                    size += len(block)
+            print(f"Resuming {url} at {size} bytes")
+        
+        total = meta.get("length") if size else None
+        interruptions = 0
+        keep = False
+        complete = False
+        try:
+            while True:
+                headers = {}
+                if size:
+                    headers["Range"] = f"bytes={size}-"
+                    if meta.get("etag") or meta.get("last_modified"):
+                        headers["If-Range"] = meta.get("etag") or meta.get("last_modified")
+                try:
+                    with self.fetcher.host_slot(url):
+                        response = self.http.get(url, cancel_event, stream=True, headers=headers)
+                        try:
+                            if size and response.status_code == 416 and size == total:
+                                break  # The .part already holds everything
+                            if size and response.status_code == 206:
+                                match = re.match(r"bytes (\d+)-\d+/(\d+)", response.headers.get("Content-Range", ""))
+                                if not match or int(match.group(1)) != size:
+                                    print(f"Unexpected Content-Range for {url}, starting over")
+                                    return None
+                                total = int(match.group(2))
+                            elif response.status_code == 200:
+                                if size:
+                                    print(f"Server sent the whole file again, restarting {url}")
+                                    digest = hashlib.sha256()
+                                    size = 0
+                                    head = bytearray()
+                                total = int(response.headers.get("Content-Length") or 0) or None
+                            else:
+                                print(f"Failed to download image. Status code: {response.status_code}")
+                                self.metrics.annotate(outcome=f"http_{response.status_code}")
+                                return None
+                            
+                            if total and total > max_bytes:
+                                print(f"Skipping oversized image: {total} bytes")
+                                self.metrics.annotate(outcome="oversized")
+                                return None
+                            if not size:
+                                meta = {
+                                    "url": url,
+                                    "etag": response.headers.get("ETag"),
+                                    "last_modified": response.headers.get("Last-Modified"),
+                                    "length": total
+                                }
+                                write_file_atomically(meta_path, json.dumps(meta))
+                            
+                            checkpoint_bytes = total // 4 if checkpoint and total and size < total // 4 else None
+                            # Only a progressive JPEG can be hashed before it has finished
+                            progressive = jpeg_is_progressive(head) if checkpoint_bytes else False
+                            with open(part_path, 'ab' if size else 'wb') as f:
+                                for chunk in response.iter_content(chunk_size=chunk_size):
+                                    if cancel_event is not None and cancel_event.is_set():
+                                        self.metrics.annotate(outcome="cancelled")
+                                        return None
+                                    size += len(chunk)
+                                    self.metrics.annotate(bytes=len(chunk))
+                                    self.throttle(len(chunk), cancel_event)
+                                    if size > max_bytes:
+                                        print(f"Aborting oversized image: more than {max_bytes} bytes")
+                                        self.metrics.annotate(outcome="oversized")
+                                        return None
+                                    digest.update(chunk)
+                                    f.write(chunk)
+                                    if progressive is None:
+                                        head.extend(chunk[:JPEG_HEADER_MAX - len(head)])
+                                        progressive = jpeg_is_progressive(head)
+                                        if progressive is None and len(head) >= JPEG_HEADER_MAX:
+                                            progressive = False
+                                    if progressive and size >= checkpoint_bytes:
+                                        progressive = False
+                                        f.flush()
+                                        if checkpoint(part_path):
+                                            return None
+                        finally:
+                            response.close()
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout) as e:
+                    interruptions += 1
+                    if interruptions > self.config.get("download_resume_attempts") or (
+                            cancel_event is not None and cancel_event.is_set()):
+                        print(f"Download of {url} interrupted at {size} bytes, keeping it to resume later")
+                        self.metrics.annotate(outcome="interrupted")
+                        keep = size > 0
+                        return None
+                    print(f"Download of {url} interrupted at {size} bytes, resuming: {e}")
+                    continue
+                break
+            
+            # Verify before anything trusts the file
+            if total and size != total:
+                print(f"Incomplete download of {url}: {size} of {total} bytes")
+                self.metrics.annotate(outcome="incomplete")
+                keep = True
+                return None
+            if os.path.getsize(part_path) != size:
+                print(f"Download of {url} doesn't match what was received, discarding it")
+                self.metrics.annotate(outcome="corrupt")
+                return None
+            complete = True
+            return part_path, digest.hexdigest(), size
+        finally:
+            if (not complete and cancel_event is not None and cancel_event.is_set()
+                    and not getattr(cancel_event, "cancelled", True)):
+                # Out of time rather than cancelled: a later attempt can finish it
+                keep = size > 0
+            self.candidate_check.resumable = keep and not complete
+            if complete or not keep:
+                try:
+                    os.remove(meta_path)
+                except OSError:
+                    pass
+            if not complete and not keep and os.path.exists(part_path):
+                os.remove(part_path)
+
+    def throttle(self, nbytes, cancel_event=None):
+        """Keep downloads under bandwidth_limit_kbps, if set."""
+        if self.bandwidth is not None:
+            self.bandwidth.consume(nbytes, cancel_event)
+
+    def download_with_retries(self, context):
+        """Download a new wallpaper, trying again with a different source on failure.
+
+        Stops early once context is cancelled or past its deadline.
+        """
+        wallpaper_path = self.download_new_wallpaper(context)
         
-        # If downloading fails, try again with a different source
         attempts = 0
-        while not wallpaper_path and attempts < 3:
+        while not wallpaper_path and attempts < 3 and not context.is_set():
             print(f"Attempt {attempts+1} failed. Trying again...")
-            wallpaper_path = self.download_new_wallpaper()
+            wallpaper_path = self.download_new_wallpaper(context)
             attempts += 1
         
+        return wallpaper_path
+
+    def cancel_downloads(self):
+        """Abort the running change and the prefetcher's downloads."""
+        context = self.active_change
+        if context is not None:
+            print("Cancelling the running wallpaper change")
+            context.cancel()
+        self.prefetcher.cancel_current()
+
+    def wait_idle(self, timeout):
+        """Wait up to timeout seconds for a running change to finish; return True if none is running."""
+        if not self.change_lock.acquire(timeout=timeout):
+            return False
+        self.change_lock.release()
+        return True
+
+    def remove_partial_downloads(self):
+        """Delete .part files of downloads nobody resumed, and renditions a killed run left half written.
+
+        .part files are kept for partial_max_age_hours so an interrupted
+        download can resume. Rendition temp files written to recently may
+        belong to another running instance, e.g. a harvest next to the
+        daemon, and are kept too.
+        """
+        stale_before = time.time() - self.config.get("change_timeout_seconds")
+        part_stale_before = time.time() - self.config.get("partial_max_age_hours") * 3600
+        with self.parts_lock:
+            active = {os.path.basename(self.part_path(url)) for url in self.active_parts}
+        for directory in (self.download_dir, self.rendition_dir):
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith(".part") or name.endswith(".part.json"):
+                    if name[:name.rindex(".part") + 5] in active:
+                        continue
+                    cutoff = part_stale_before
+                elif name.endswith(".tmp"):
+                    cutoff = stale_before
+                else:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                    os.remove(path)
+                    print(f"Removed unfinished file: {name}")
+                except OSError as e:
+                    print(f"Error removing {name}: {e}")
+
+    def change_wallpaper(self):
+        """Set the next wallpaper as desktop background, downloading one if none is ready."""
+        with self.change_lock:
+            profile_path = self.profile_next_change
+            if profile_path:
+                # Profile just this one change
+                self.profile_next_change = None
+                if self.config.get("profile_next_change"):
+                    self.config.set("profile_next_change", "")
+                profiler = cProfile.Profile()
+                try:
+                    profiler.runcall(self.run_change)
+                finally:
+                    profiler.dump_stats(profile_path)
+                    print(f"Profile of this change written to {profile_path}")
+            else:
+                self.run_change()
+            self.export_metrics()
+            self.write_status()
+
+    @timed_stage("change", source="all")
+    def run_change(self):
+        """Pick or download the next wallpaper and set it."""
+        # Stages of this thread belong to no source until one is picked
+        self.metrics.set_source(None)
+        context = ChangeContext(self.config.get("change_timeout_seconds"))
+        self.active_change = context
+        try:
+            self.run_change_steps(context)
+        finally:
+            self.active_change = None
+
+    def run_change_steps(self, context):
+        """The steps of run_change, giving up on the network once context is set."""
+        wallpaper_path = None
+        policy = self.config.get("library_policy")
+        
+        # Reuse a wallpaper from the library without touching the network
+        if policy == "prefer":
+            wallpaper_path = self.pick_from_library(self.config.get("library_repeat_hours") * 3600)
+            outcome = "library"
+        
+        # Use a prefetched wallpaper if one is ready
+        if not wallpaper_path:
+            wallpaper_path = self.prefetcher.take()
+            outcome = "prefetched"
+        if not wallpaper_path:
+            wallpaper_path = self.download_with_retries(context)
+            outcome = "downloaded"
+        
+        # Stopped, quitting or settings changed: leave the desktop alone
+        if context.cancelled:
+            print("Wallpaper change cancelled.")
+            self.metrics.annotate(outcome="cancelled")
+            return
+        
+        # Offline, out of time or every source failed: show something we already have
+        if not wallpaper_path and policy in ("fallback", "prefer"):
+            wallpaper_path = self.pick_from_library(0)
+            outcome = "library_fallback"
+            if wallpaper_path:
+                print(f"Download failed, reusing wallpaper from the library: {wallpaper_path}")
+        
         if not wallpaper_path:
             print("Failed to download a new wallpaper after multiple attempts.")
+            self.metrics.annotate(outcome="failed")
             return
+        self.metrics.annotate(outcome=outcome)
+        
+        # Set the copy scaled to the display, but track the original
+        original_path = wallpaper_path
+        wallpaper_path = self.get_rendition(original_path)
         
         try:
             print(f"Setting new wallpaper: {wallpaper_path}")
-            
-            if self.system == "Windows":
-                # For Windows
-                ctypes.windll.user32.SystemParametersInfoW(20, 0, os.path.abspath(wallpaper_path), 3)
-            
-            elif self.system == "Darwin":  # macOS
-                # For macOS (requires osascript)
-                script = f'''
-                tell application "System Events"
-                    set desktop picture to POSIX file "{os.path.abspath(wallpaper_path)}"
-                end tell
-                '''
-                os.system(f"osascript -e '{script}'")
-            
-            elif self.system == "Linux":
-                # For Linux (assuming GNOME)
-                os.system(f"gsettings set org.gnome.desktop.background picture-uri file://{os.path.abspath(wallpaper_path)}")
-                # For KDE Plasma
-                os.system(f"qdbus org.kde.plasmashell /PlasmaShell org.kde.PlasmaShell.evaluateScript '\
-                    var allDesktops = desktops();\
-                    for (i=0;i<allDesktops.length;i++) {{\
-                        d = allDesktops[i];\
-                        d.wallpaperPlugin = \"org.kde.image\";\
-                        d.currentConfigGroup = Array(\"Wallpaper\", \"org.kde.image\", \"General\");\
-                        d.writeConfig(\"Image\", \"file://{os.path.abspath(wallpaper_path)}\");\
-                    }}'\
-                ")
-            
-            print("Wallpaper set successfully.")
+            if self.set_wallpaper(wallpaper_path):
+                print("Wallpaper set successfully.")
+                self.library.mark_shown(original_path)
+            else:
+                print("Wallpaper not applied: the wallpaper setter is none.")
+            self.current_wallpaper = original_path
+            self.last_change_at = time.time()
             
             # Clean up old wallpapers to avoid filling up disk space
-            # Keep only the most recent wallpaper
-            self.cleanup_old_wallpapers(except_path=wallpaper_path)
+            self.cleanup_old_wallpapers(except_path=original_path)
             
         except Exception as e:
             print(f"Error setting wallpaper: {e}")
+            self.metrics.annotate(outcome="set_failed")
 
-    def cleanup_old_wallpapers(self, except_path=None):
-        """Delete old wallpapers except the current one to save disk space."""
+    @timed_stage("set")
+    def set_wallpaper(self, wallpaper_path):
+        """Hand an image file to the desktop environment through the setter backend.
+
+        Returns False if nothing was applied because the setter is none.
+        """
+        if self.setter_name == "none":
+            self.metrics.annotate(outcome="not_applied")
+            return False
+        started = time.perf_counter()
         try:
-            wallpapers = [os.path.join(self.download_dir, file) for file in os.listdir(self.download_dir) 
-                         if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
-            
-            for wallpaper in wallpapers:
-                if except_path and os.path.abspath(wallpaper) == os.path.abspath(except_path):
-                    continue  # Skip the current wallpaper
+            self.setter(os.path.abspath(wallpaper_path))
+        except Exception as e:
+            raise RuntimeError(f"{self.setter_name} setter failed: {e}") from e
+        print(f"Wallpaper set by the {self.setter_name} setter in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return True
+
+    def get_display_size(self):
+        """Return the display size from the config, or detect it."""
+        configured = self.config.get("display_size")
+        if configured:
+            try:
+                width, height = configured.lower().split("x")
+                return int(width), int(height)
+            except ValueError:
+                print(f"Invalid display_size {configured!r}, detecting it instead")
+        return detect_display_size(self.system)
+
+    def rendition_path(self, path):
+        """Return where the display-sized copy of the wallpaper at path is cached."""
+        name = os.path.splitext(os.path.basename(path))[0]
+        width, height = self.display_size
+        return os.path.join(self.rendition_dir, f"{name}.{width}x{height}.jpg")
+
+    @timed_stage("rendition")
+    def get_rendition(self, path):
+        """Return a copy of the wallpaper at path scaled to the display, creating it once.
+
+        Falls back to the original if renditions are off, the display size is
+        unknown, the image already has the display size, or scaling fails.
+        """
+        if not self.display_size:
+            self.metrics.annotate(outcome="original")
+            return path
+        rendition = self.rendition_path(path)
+        if os.path.exists(rendition):
+            self.metrics.annotate(outcome="cached")
+            return rendition
+        try:
+            with Image.open(path) as img:
+                if img.size == self.display_size:
+                    self.metrics.annotate(outcome="original")
+                    return path
+            os.makedirs(self.rendition_dir, exist_ok=True)
+            make_rendition(path, rendition, self.display_size, self.config.get("rendition_quality"))
+            return rendition
+        except Exception as e:
+            print(f"Error creating rendition of {path}: {e}")
+            self.metrics.annotate(outcome="error")
+            return path
+
+    def remove_renditions(self, path):
+        """Delete the display-sized copies of an evicted wallpaper, for any display size."""
+        if not os.path.isdir(self.rendition_dir):
+            return
+        name = os.path.splitext(os.path.basename(path))[0]
+        pattern = re.compile(re.escape(name) + r"\.\d+x\d+\.jpg")
+        for file in os.listdir(self.rendition_dir):
+            if pattern.fullmatch(file):
                 try:
-                    os.remove(wallpaper)
-                    print(f"Removed old wallpaper: {wallpaper}")
+                    os.remove(os.path.join(self.rendition_dir, file))
                 except Exception as e:
-                    print(f"Failed to remove {wallpaper}: {e}")
+                    print(f"Failed to remove rendition {file}: {e}")
+
+    def pick_from_library(self, min_age_seconds):
+        """Pick a downloaded wallpaper of the current type that isn't on screen or queued."""
+        exclude = self.prefetcher.buffered_paths()
+        if self.current_wallpaper:
+            exclude.append(self.current_wallpaper)
+        return self.library.pick(self.config.get("wallpaper_type"), min_age_seconds, exclude)
+
+    @timed_stage("cleanup", source="all")
+    def cleanup_old_wallpapers(self, except_path=None):
+        """Evict the least recently shown wallpapers once the library is over its disk budget."""
+        try:
+            # Keep the current wallpaper and the ones waiting in the prefetch buffer
+            keep = self.prefetcher.buffered_paths()
+            if except_path:
+                keep.append(except_path)
+            evicted = self.library.evict(self.config.get("library_max_mb") * 1024 * 1024, keep)
+            for sha256, path in evicted:
+                self.phash_index.remove(sha256)
+                self.remove_renditions(path)
+            # Interrupted downloads nobody came back for
+            self.remove_partial_downloads()
+            self.metrics.annotate(outcome="evicted" if evicted else "ok")
         except Exception as e:
             print(f"Error during cleanup: {e}")
+            self.metrics.annotate(outcome="error")
+
+    def export_metrics(self):
+        """Write the pipeline metrics to the configured JSON and Prometheus files."""
+        exports = (
+            ("metrics_json_file", self.metrics.write_json),
+            ("metrics_prometheus_file", self.metrics.write_prometheus)
+        )
+        for key, write in exports:
+            name = self.config.get(key)
+            if not name:
+                continue
+            try:
+                # Relative names go next to the wallpapers
+                write(os.path.join(self.download_dir, name))
+            except Exception as e:
+                print(f"Error writing metrics to {name}: {e}")
 
     def start_timer(self):
         """Start the timer to change wallpaper periodically."""
@@ -268,40 +2589,48 @@ class WallpaperChanger:
             return
         
         self.running = True
-        self.schedule_next_change()
+        if self.config.get("prefetch_count") > 0:
+            self.prefetcher.start()
+        self.scheduler.start()
+        self.write_status()
         
     def stop_timer(self):
-        """Stop the timer."""
+        """Stop the timer and abort any download in flight."""
         self.running = False
-        if self.timer:
-            self.timer.cancel()
-            self.timer = None
+        self.scheduler.stop()
+        self.cancel_downloads()
+
+    def write_status(self):
+        """Record the current wallpaper and schedule for the status command."""
+        try:
+            status = {
+                "pid": os.getpid(),
+                "wallpaper_type": self.config.get("wallpaper_type"),
+                "current_wallpaper": self.current_wallpaper,
+                "changed_at": self.last_change_at,
+                "next_change_at": self.scheduler.next_change_time(),
+                "setter": self.setter_name,
+                "library_wallpapers": self.library.count(),
+                "library_mb": round(self.library.total_bytes() / (1024 * 1024), 1)
+            }
+            write_file_atomically(os.path.join(self.download_dir, "status.json"), json.dumps(status, indent=4))
+        except Exception as e:
+            print(f"Error writing status: {e}")
+
+    def request_change(self):
+        """Change the wallpaper now on the scheduler thread."""
+        self.scheduler.request_change()
 
-    def schedule_next_change(self):
-        """Schedule the next wallpaper change."""
-        if not self.running:
+    def prepare_next_wallpaper(self):
+        """Download the next wallpaper ahead of its change unless one is ready."""
+        if self.prefetcher.buffered_paths():
             return
-            
-        # Cancel any existing timer
-        if self.timer:
-            self.timer.cancel()
-        
-        # Get frequency in minutes from config
-        frequency_minutes = self.config.get("frequency_minutes")
-        
-        # Schedule next change
-        self.timer = threading.Timer(frequency_minutes * 60, self.handle_timer_event)
-        self.timer.daemon = True
-        self.timer.start()
-        
-        print(f"Next wallpaper change scheduled in {frequency_minutes} minutes")
-    
-    def handle_timer_event(self):
-        """Handle the timer event - change wallpaper and reschedule."""
-        if self.running:
-            print("Timer triggered, changing wallpaper...")
-            self.change_wallpaper()
-            self.schedule_next_change()
+        if self.prefetcher.is_refilling():
+            # The refill thread is most likely downloading already; don't start a second one
+            self.prefetcher.wake()
+            return
+        print("Preparing the next wallpaper...")
+        self.prefetcher.fill_one()
 
     def add_to_startup_windows(self, enable=True):
         """Add or remove the application from Windows startup."""
@@ -339,10 +2668,10 @@ class WallpaperChanger:
             winreg.CloseKey(startup_key)
 
 class WallpaperChangerGUI:
-    def __init__(self, root):
+    def __init__(self, root, config_file="wallpaper_config.json"):
         self.root = root
         self.root.withdraw()  # Hide the main window initially
-        self.changer = WallpaperChanger()
+        self.changer = WallpaperChanger(config_file)
         
         # Create system tray icon
         self.create_tray_icon()
@@ -413,7 +2742,7 @@ class WallpaperChangerGUI:
     
     def change_wallpaper_now(self):
         """Manually trigger wallpaper change."""
-        threading.Thread(target=self.changer.change_wallpaper).start()
+        self.changer.request_change()
     
     def open_settings(self):
         """Open the settings window."""
@@ -485,11 +2814,17 @@ class WallpaperChangerGUI:
                 messagebox.showerror("Invalid Input", "Frequency must be at least 1 minute")
                 return
                 
+            type_changed = wallpaper_type != self.changer.config.get("wallpaper_type")
+            
             # Save settings
             self.changer.config.set("wallpaper_type", wallpaper_type)
             self.changer.config.set("frequency_minutes", frequency_minutes)
             self.changer.config.set("run_on_startup", run_on_startup)
             
+            # Prefetched wallpapers belong to the old type
+            if type_changed:
+                self.changer.prefetcher.invalidate()
+            
             # Handle startup setting
             self.changer.add_to_startup_windows(run_on_startup)
             
@@ -505,14 +2840,208 @@ class WallpaperChangerGUI:
     def quit_application(self):
         """Quit the application."""
         self.changer.stop_timer()
+        self.changer.prefetcher.stop()
+        # Give the cancelled change a moment to delete its partial download
+        self.changer.wait_idle(5)
         self.tray_icon.stop()
         self.root.quit()
 
-def main():
-    """Main function to run the wallpaper changer with GUI."""
+def daemon_pid_file(config):
+    return os.path.join(config.get("download_dir"), "daemon.pid")
+
+def status_file(config):
+    return os.path.join(config.get("download_dir"), "status.json")
+
+def running_daemon_pid(config):
+    """Return the pid of the running headless daemon, or None.
+
+    The daemon holds a lock on its pid file for as long as it runs, so a
+    file left behind by a crashed daemon, whose pid may since belong to an
+    unrelated process, is ignored. Only on systems with SIGUSR1: on
+    Windows os.kill would terminate the process.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return None
+    import fcntl
+    try:
+        with open(daemon_pid_file(config), 'r') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return int(f.read().strip())
+            return None  # Nobody holds the lock
+    except (OSError, ValueError):
+        return None
+
+def lock_pid_file(path):
+    """Write our pid to path and lock it; return the open file, or None if a live daemon holds it.
+
+    The lock is released when the process exits, however it exits.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    f = open(path, 'a+')
+    if hasattr(signal, "SIGUSR1"):
+        import fcntl
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    return f
+
+def run_daemon(config_file):
+    """Change wallpapers without any GUI until SIGTERM or Ctrl+C."""
+    config = WallpaperChangerConfig(config_file)
+    pid_file = daemon_pid_file(config)
+    pid_lock = lock_pid_file(pid_file)
+    if pid_lock is None:
+        print(f"A wallpaper changer daemon is already running (pid {running_daemon_pid(config)})")
+        return 1
+    changer = WallpaperChanger(config_file)
+    
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *args: stop_event.set())
+    if hasattr(signal, "SIGUSR1"):
+        # Sent by the change-now command
+        signal.signal(signal.SIGUSR1, lambda *args: changer.request_change())
+    
+    print(f"Wallpaper changer daemon running (pid {os.getpid()})")
+    changer.request_change()
+    changer.start_timer()
+    try:
+        while not stop_event.is_set():
+            stop_event.wait(1)
+    finally:
+        changer.stop_timer()
+        changer.prefetcher.stop()
+        # Give the cancelled change a moment to delete its partial download
+        changer.wait_idle(5)
+        changer.write_status()
+        try:
+            os.remove(pid_file)
+        except OSError:
+            pass
+        pid_lock.close()
+        print("Wallpaper changer daemon stopped")
+    return 0
+
+def change_now(config_file):
+    """Ask the running daemon for a change, or change the wallpaper in this process."""
+    config = WallpaperChangerConfig(config_file)
+    pid = running_daemon_pid(config)
+    if pid:
+        os.kill(pid, signal.SIGUSR1)
+        print(f"Asked the daemon (pid {pid}) to change the wallpaper")
+        return 0
+    
+    changer = WallpaperChanger(config_file)
+    changer.change_wallpaper()
+    changer.fetcher.shutdown(wait=True)
+    return 0 if changer.current_wallpaper else 1
+
+def harvest(config_file, args):
+    """Fill the library with wallpapers for every category."""
+    changer = WallpaperChanger(config_file)
+    # Per-host slots are created on first use, so this still applies
+    changer.fetcher.per_host = args.per_host or changer.config.get("per_host_connections")
+    if args.limit_kbps is not None:
+        changer.bandwidth = BandwidthLimiter(args.limit_kbps * 1024) if args.limit_kbps else None
+    
+    categories = args.categories.split(",") if args.categories else None
+    unknown = [category for category in categories or [] if category not in changer.wallpaper_sources]
+    if unknown:
+        print(f"Unknown categories: {', '.join(unknown)}")
+        return 2
+    harvester = WallpaperHarvester(
+        changer, args.count, categories,
+        workers=args.workers or changer.config.get("max_concurrent_fetches"),
+        restart=args.restart
+    )
+    signal.signal(signal.SIGINT, lambda *args: harvester.stop())
+    signal.signal(signal.SIGTERM, lambda *args: harvester.stop())
+    
+    # Run in a thread so the main thread stays free to handle Ctrl+C
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(complete=harvester.run()))
+    thread.start()
+    while thread.is_alive():
+        thread.join(0.5)
+    changer.fetcher.shutdown(wait=True)
+    
+    if harvester.stop_event.is_set():
+        print("Harvest interrupted, run it again to resume")
+        return 1
+    return 0 if result.get("complete") else 1
+
+def print_status(config_file):
+    """Print what the daemon or tray application last reported."""
+    config = WallpaperChangerConfig(config_file)
+    pid = running_daemon_pid(config)
+    print(f"Daemon: running (pid {pid})" if pid else "Daemon: not running")
+    try:
+        with open(status_file(config), 'r') as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        print("No status yet: the wallpaper has not been changed.")
+        return 0
+    
+    def when(timestamp):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) if timestamp else "never"
+    
+    print(f"Wallpaper type: {status.get('wallpaper_type')}")
+    print(f"Current wallpaper: {status.get('current_wallpaper') or 'none'}")
+    print(f"Last change: {when(status.get('changed_at'))}")
+    if status.get("next_change_at"):
+        print(f"Next change: {when(status.get('next_change_at'))}")
+    print(f"Setter: {status.get('setter')}")
+    print(f"Library: {status.get('library_wallpapers')} wallpapers, {status.get('library_mb')} MB")
+    
+    health = SourceHealth(os.path.join(config.get("download_dir"), "source_health.json"))
+    for source, stats in health.sources.items():
+        tried = stats["successes"] + stats["failures"]
+        rate = f"{stats['successes'] / tried:.0%}" if tried else "untried"
+        latency = f"{stats['latency']:.1f} s" if stats["latency"] is not None else "-"
+        usable = f"{stats['usable']:.0%}" if stats.get("usable") is not None else "-"
+        state = "skipped until " + when(stats["open_until"]) if stats["open_until"] > time.time() else "ok"
+        print(f"Source {source}: {rate} recent success, {latency} per attempt, {usable} usable, {state}")
+    return 0
+
+def main(argv=None):
+    """Run the tray application, or one of the headless commands."""
+    parser = argparse.ArgumentParser(description="Download wallpapers and change the desktop background periodically.")
+    parser.add_argument("--config", default="wallpaper_config.json", help="config file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("gui", help="run with a system tray icon (the default)")
+    commands.add_parser("run", help="run headless until stopped, e.g. as a systemd user service")
+    commands.add_parser("change-now", help="change the wallpaper now, through the daemon if it is running")
+    commands.add_parser("status", help="show the current wallpaper and the next change")
+    harvest_parser = commands.add_parser("harvest", help="download wallpapers for every category into the library")
+    harvest_parser.add_argument("--count", type=int, default=20, help="wallpapers per category (default: %(default)s)")
+    harvest_parser.add_argument("--categories", help="comma-separated categories (default: all)")
+    harvest_parser.add_argument("--workers", type=int, help="downloads at once (default: max_concurrent_fetches)")
+    harvest_parser.add_argument("--per-host", type=int, help="downloads at once per host (default: per_host_connections)")
+    harvest_parser.add_argument("--limit-kbps", type=int, help="bandwidth cap in KB/s, 0 for none (default: bandwidth_limit_kbps)")
+    harvest_parser.add_argument("--restart", action="store_true", help="ignore the progress of an earlier harvest")
+    args = parser.parse_args(argv)
+    
+    if args.command == "run":
+        return run_daemon(args.config)
+    if args.command == "change-now":
+        return change_now(args.config)
+    if args.command == "status":
+        return print_status(args.config)
+    if args.command == "harvest":
+        return harvest(args.config, args)
+    
     root = tk.Tk()
-    app = WallpaperChangerGUI(root)
+    app = WallpaperChangerGUI(root, args.config)
     root.mainloop()
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file